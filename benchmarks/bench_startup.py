@@ -0,0 +1,118 @@
+'''
+Benchmark the start up time of upload.py, as cron wrappers run it:
+    help     upload.py --help
+    dry-run  upload.py --dry-run on a small directory
+Each command is run --runs times in a fresh interpreter, and the min, median and
+mean wall time reported, with the heavy dependencies the command imported.
+
+To compare with an older version, check it out in a worktree and run both:
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/bench_startup.py --repo /tmp/before
+    python benchmarks/bench_startup.py
+'''
+
+import argparse
+import json
+from pathlib import Path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = Path(__file__).resolve().parent.parent
+
+# imported by the upload and compare paths only
+HEAVY = ('PIL', 'ffmpeg', 'arrow', 'dateutil', 'requests', 'google.auth', 'google_auth_oauthlib')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, allow_abbrev=False,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20,
+            help='Runs of each command. Default: 20')
+    parser.add_argument('--files', type=int, default=20,
+            help='Files in the directory for --dry-run. Default: 20')
+    parser.add_argument('--repo', type=Path, default=REPO,
+            help='Checkout whose upload.py is run. Default: this one')
+    parser.add_argument('--json', metavar='json_file', dest='json_file',
+            help='Also write the results to this file')
+    return parser.parse_args()
+
+def commands(repo, tree):
+    upload = str(repo / 'upload.py')
+    return {
+        'help': [upload, '--help'],
+        'dry-run': [upload, '-c', 'unused', '--album', 'Startup', '--dry-run', str(tree)],
+    }
+
+def run_once(argv, cwd):
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + argv, cwd=cwd, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def heavy_imports(argv, cwd):
+    ''' the HEAVY packages imported, from -X importtime '''
+
+    err = subprocess.run([sys.executable, '-X', 'importtime'] + argv, cwd=cwd,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    imported = set()
+    for line in err.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        module = line.rsplit('|', 1)[-1].strip()
+        for heavy in HEAVY:
+            if module == heavy or module.startswith(heavy + '.'):
+                imported.add(heavy)
+    return sorted(imported)
+
+def timings(argv, cwd, runs):
+    # warm the page cache and __pycache__ first
+    run_once(argv, cwd)
+    seconds = [run_once(argv, cwd) for _ in range(runs)]
+    return {
+        'runs': runs,
+        'min_ms': round(min(seconds) * 1000, 1),
+        'median_ms': round(statistics.median(seconds) * 1000, 1),
+        'mean_ms': round(statistics.mean(seconds) * 1000, 1),
+        'heavy_imports': heavy_imports(argv, cwd),
+    }
+
+def run(args, tree):
+    tree.mkdir(parents=True, exist_ok=True)
+    for i in range(args.files):
+        (tree / 'img_{:04d}.jpg'.format(i)).write_bytes(b'\xff\xd8\xff' + bytes(1024))
+
+    # the interpreter alone, the floor for the others
+    results = {'python': timings(['-c', 'pass'], args.repo, args.runs)}
+    for name, argv in commands(args.repo, tree).items():
+        results[name] = timings(argv, args.repo, args.runs)
+    return results
+
+def report(results, repo):
+    print('{:<8} | {:>8} | {:>9} | {:>8} | {}'.format('command', 'min ms', 'median ms', 'mean ms', 'heavy imports'))
+    for name in ('python', 'help', 'dry-run'):
+        r = results[name]
+        print('{:<8} | {:>8} | {:>9} | {:>8} | {}'.format(name, r['min_ms'], r['median_ms'], r['mean_ms'],
+                ', '.join(r['heavy_imports']) or '-'))
+    print('')
+    print('{:<8} | {}'.format('repo', repo))
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='gphotos-startup-')
+    try:
+        results = run(args, Path(workdir) / 'tree')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results, args.repo)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,231 @@
+'''
+Benchmark album listing, comparing and uploading against fake_photos_api.FakePhotosAPI.
+
+Generates a tree of JPEG files, some of them already in the album, then times:
+    list     albums and album contents, indexed as upload.py does
+    compare  upload.media_comparison of every file with the album
+    upload   upload.upload_photos, or the async backend with --backend async
+and reports files/s, MB/s, and p50/p99 latency per file, from the start of its
+upload to its mediaItems:batchCreate.
+
+Options not listed here are upload.py's, e.g.
+    python benchmarks/bench_upload.py --files 500 --latency 50 -- -w 8 --batch-wait 5
+'''
+
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from google.auth.transport.requests import AuthorizedSession
+from PIL import Image
+
+from fake_photos_api import FakePhotosAPI
+import upload
+from utils import album_contents, metrics, setup
+from utils.scheduler import RequestScheduler, ScheduledSession
+
+ALBUM = 'Benchmark'
+EXIF_DATETIME = 306
+# winter, so exif times in Europe/London are UTC
+BASE_TIME = 1579082400
+
+class StaticCredentials:
+    ''' Enough of google.auth credentials for AuthorizedSession and the async backend '''
+
+    token = 'benchmark'
+    valid = True
+    expired = False
+
+    def apply(self, headers, token=None):
+        headers['authorization'] = 'Bearer {}'.format(token or self.token)
+
+    def before_request(self, request, method, url, headers):
+        self.apply(headers)
+
+    def refresh(self, request):
+        pass
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, allow_abbrev=False,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=200,
+            help='Number of files to generate. Default: 200')
+    parser.add_argument('--file-kb', type=int, default=256,
+            help='Size of each file in KB. Default: 256')
+    parser.add_argument('--in-album', type=float, default=0.5,
+            help='Fraction of the files already in the album, so they are passed. Default: 0.5')
+    parser.add_argument('--album-items', type=int, default=1000,
+            help='Other items in the album, not on disk. Default: 1000')
+    parser.add_argument('--latency', type=float, default=20,
+            help='Milliseconds added to each request. Default: 20')
+    parser.add_argument('--bandwidth', type=float, default=0,
+            help='Upload bandwidth in MB/s, shared by all uploads, 0 for unlimited. Default: 0')
+    parser.add_argument('--error-rate', type=float, default=0,
+            help='Fraction of requests failing with 503. Default: 0')
+    parser.add_argument('--seed', type=int, default=1,
+            help='Random seed for the errors. Default: 1')
+    parser.add_argument('--workdir',
+            help='Directory for the generated files, kept afterwards. Default: a temporary directory')
+    parser.add_argument('--json', metavar='json_file', dest='json_file',
+            help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true',
+            help="Show upload.py's log")
+
+    args, upload_args = parser.parse_known_args()
+    if upload_args and upload_args[0] == '--':
+        upload_args = upload_args[1:]
+    return args, upload_args
+
+def exif_time(i):
+    return time.strftime('%Y:%m:%d %H:%M:%S', time.gmtime(BASE_TIME + i))
+
+def creation_time(i):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(BASE_TIME + i))
+
+def make_tree(tree, number, size):
+    ''' number JPEGs with exif DateTime, padded to size bytes.  Returns their paths '''
+
+    tree.mkdir(parents=True, exist_ok=True)
+    image = Image.new('RGB', (16, 16), (90, 120, 200))
+    paths = []
+    for i in range(number):
+        path = tree / 'img_{:06d}.jpg'.format(i)
+        exif = Image.Exif()
+        exif[EXIF_DATETIME] = exif_time(i)
+        image.save(path, 'JPEG', exif=exif.tobytes())
+        with open(path, 'ab') as f:
+            f.write(os.urandom(max(0, size - path.stat().st_size)))
+        paths.append(path)
+    return paths
+
+def seed_album(api, paths, in_album, album_items):
+    album = api.add_album(ALBUM)
+    for i, path in enumerate(paths[:int(len(paths) * in_album)]):
+        api.add_media_item(album['id'], path.name, 'image/jpeg', creation_time(i))
+    for i in range(album_items):
+        api.add_media_item(album['id'], 'other_{:06d}.jpg'.format(i), 'image/jpeg', creation_time(i))
+    # albums not created by this app are listed too
+    for i in range(30):
+        api.add_album('Other {}'.format(i), app_created=False)
+    return album
+
+def percentile(values, p):
+    ''' nearest rank '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(p / 100 * len(values))) - 1)]
+
+def phase(results, name, elapsed, files=0, size=0, latencies=()):
+    results[name] = {
+        'seconds': round(elapsed, 3),
+        'files': files,
+        'files_per_s': round(files / elapsed, 1) if elapsed else None,
+        'mb_per_s': round(size / elapsed / 1024 / 1024, 2) if elapsed else None,
+    }
+    if latencies:
+        results[name]['p50_ms'] = round(percentile(latencies, 50) * 1000, 1)
+        results[name]['p99_ms'] = round(percentile(latencies, 99) * 1000, 1)
+
+def run(args, upload_args, tree):
+    paths = make_tree(tree, args.files, args.file_kb * 1024)
+
+    api = FakePhotosAPI(args.latency / 1000, args.bandwidth * 1024 * 1024, args.error_rate, args.seed)
+    album_contents.API_URL = api.start()
+    try:
+        seed_album(api, paths, args.in_album, args.album_items)
+
+        upload_args = setup.parse_args(['-c', 'unused', '--album', ALBUM, '--no-atime']
+                + upload_args + [str(tree)])
+        scheduler = RequestScheduler(upload_args.rate, upload_args.max_requests, upload_args.retries)
+        session = ScheduledSession(AuthorizedSession(StaticCredentials()), scheduler)
+
+        results = {}
+        started = time.monotonic()
+        catalog = album_contents.AlbumCatalog(session)
+        album_exists, album_content_details = upload.get_album_and_contents(session, upload_args, catalog)
+        phase(results, 'list', time.monotonic() - started, len(album_content_details))
+
+        started = time.monotonic()
+        upload.media_comparison(upload_args, paths, album_content_details)
+        phase(results, 'compare', time.monotonic() - started, len(paths))
+
+        uploader = upload.upload_photos
+        if upload_args.backend == 'async':
+            import upload_async
+            uploader = upload_async.upload_photos
+
+        # a fresh catalog, so the upload lists albums as a run would
+        catalog = album_contents.AlbumCatalog(session)
+        received = api.bytes_received
+        started = time.monotonic()
+        counts = uploader(session, upload.iter_photo_files([tree], upload_args), upload_args, catalog)
+        elapsed = time.monotonic() - started
+
+        latencies = [api.created[name] - api.upload_started[name]
+                for name in api.created if name in api.upload_started]
+        phase(results, 'upload', elapsed, counts['added'], api.bytes_received - received, latencies)
+        results['upload']['passed'] = counts['passed']
+
+        results['requests'] = dict(sorted(api.requests.items()))
+        results['errors_injected'] = api.errors
+        results['scheduler'] = scheduler.report()
+        results['metrics'] = metrics.REGISTRY.report()
+        results['setup'] = {
+            'files': args.files, 'file_kb': args.file_kb, 'in_album': args.in_album,
+            'album_items': args.album_items, 'latency_ms': args.latency,
+            'bandwidth_mb_s': args.bandwidth, 'error_rate': args.error_rate,
+            'upload_args': ' '.join(upload_args_text(upload_args)),
+        }
+        return results
+    finally:
+        api.stop()
+
+def upload_args_text(upload_args):
+    return ['{}={}'.format(k, v) for k, v in sorted(vars(upload_args).items())
+            if k in ('backend', 'workers', 'concurrency', 'probe_workers', 'batch_size', 'batch_wait',
+                     'resumable_mb', 'chunk_mb', 'rate', 'skip_compare')]
+
+def report(results):
+    print('{:<8} | {:>8} | {:>6} | {:>8} | {:>7} | {:>8} | {:>8}'.format(
+        'phase', 'seconds', 'files', 'files/s', 'MB/s', 'p50 ms', 'p99 ms'))
+    for name in ('list', 'compare', 'upload'):
+        r = results[name]
+        print('{:<8} | {:>8} | {:>6} | {:>8} | {:>7} | {:>8} | {:>8}'.format(
+            name, r['seconds'], r['files'], r['files_per_s'], r['mb_per_s'] if name == 'upload' else '',
+            r.get('p50_ms', ''), r.get('p99_ms', '')))
+    print('')
+    print('{:<8} | {}'.format('passed', results['upload']['passed']))
+    print('{:<8} | {}'.format('requests', ', '.join('{}: {}'.format(k, v) for k, v in results['requests'].items())))
+    print('{:<8} | {} injected, {}'.format('errors', results['errors_injected'], results['scheduler']))
+    print('{:<8} | {}'.format('options', results['setup']['upload_args']))
+
+def main():
+    args, upload_args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='gphotos-bench-')
+    tree = Path(workdir) / 'tree'
+    try:
+        results = run(args, upload_args, tree)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
+
+# vim: ai et ts=4 sw=4 sts=4 nu
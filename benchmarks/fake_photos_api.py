@@ -0,0 +1,457 @@
+'''
+A local stand-in for the parts of the Google Photos Library API used by upload.py:
+albums (list and create), uploads (raw and resumable), mediaItems:batchCreate,
+mediaItems:search, mediaItems:list and albums:batchAddMediaItems.
+
+Resources carry the fields the real API returns, with partial responses for
+a fields mask, and responses are gzipped for a User-Agent containing gzip, as Google's are.
+Latency is added to every request, upload bodies are slowed to a shared bandwidth,
+and a fraction of requests fail with 503 and Retry-After, so uploads can be
+measured offline.  Point the tool at it with GPHOTOS_API_URL, see bench_upload.py
+'''
+
+from datetime import datetime, timezone
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import mimetypes
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+ALBUMS_PAGE_SIZE = (20, 50)
+SEARCH_PAGE_SIZE = (25, 100)
+CHUNK_GRANULARITY = 256 * 1024
+
+class FakePhotosAPI:
+    '''
+    latency in seconds per request, bandwidth in bytes per second shared by
+    all uploads (0 for unlimited), error_rate the fraction of requests failing with 503
+    '''
+
+    def __init__(self, latency=0, bandwidth=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.link_free = 0.0
+
+        self.albums = []
+        self.items = {}
+        # every media item, in any album or none, in the order created
+        self.library = {}
+        self.tokens = {}
+        self.resumable = {}
+
+        # per file name, when its upload started and when it was added to an album
+        self.upload_started = {}
+        self.created = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.requests = {}
+        self.errors = 0
+
+        self.server = None
+
+    def next_id(self, prefix):
+        with self.lock:
+            return '{}{}'.format(prefix, next(self.ids))
+
+    def add_album(self, title, app_created=True):
+        album_id = self.next_id('album')
+        album = {'id': album_id, 'title': title, 'isWriteable': app_created,
+                'productUrl': 'https://photos.google.com/lr/album/{}{}'.format(album_id, 'A' * 60),
+                'coverPhotoBaseUrl': 'https://lh3.googleusercontent.com/lr/{}'.format('B' * 160),
+                'coverPhotoMediaItemId': 'C' * 98}
+        with self.lock:
+            self.albums.append((album, app_created))
+            self.items[album['id']] = []
+        return album
+
+    def add_media_item(self, album_id, filename, mime_type, creation_time):
+        ''' album_id None for an item in the library only '''
+        media_id = self.next_id('media')
+        item = {
+            'id': media_id,
+            'productUrl': 'https://photos.google.com/lr/photo/{}{}'.format(media_id, 'D' * 90),
+            'baseUrl': 'https://lh3.googleusercontent.com/lr/{}'.format('E' * 300),
+            'mimeType': mime_type,
+            'mediaMetadata': {
+                'creationTime': creation_time,
+                'width': '4032',
+                'height': '3024',
+                'photo': {'cameraMake': 'Google', 'cameraModel': 'Pixel 4a', 'focalLength': 4.38,
+                          'apertureFNumber': 1.7, 'isoEquivalent': 55, 'exposureTime': '0.008s'},
+            },
+            'filename': filename,
+        }
+        with self.lock:
+            self.library[media_id] = item
+            if album_id is not None:
+                self.items[album_id].append(item)
+        return item
+
+    def album_list(self, app_created_only):
+        with self.lock:
+            albums = []
+            for album, app_created in self.albums:
+                if app_created_only and not app_created:
+                    continue
+                album = dict(album)
+                album['mediaItemsCount'] = str(len(self.items[album['id']]))
+                albums.append(album)
+            return albums
+
+    def transfer(self, size):
+        ''' Wait for size bytes to cross the shared link '''
+
+        if not self.bandwidth or not size:
+            return
+        with self.lock:
+            start = max(time.monotonic(), self.link_free)
+            self.link_free = start + size / self.bandwidth
+            done = self.link_free
+        time.sleep(max(0, done - time.monotonic()))
+
+    def count(self, endpoint):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def should_fail(self):
+        with self.lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def start(self, host='127.0.0.1', port=0):
+        ''' Serve on a background thread.  Returns the API URL, for GPHOTOS_API_URL '''
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://{}:{}/v1'.format(*self.server.server_address[:2])
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def parse_fields(text):
+    '''
+    A partial response fields mask, such as 'items(id,meta/time),next', as nested dicts
+    of the fields selected, {'items': {'id': None, 'meta': {'time': None}}, 'next': None},
+    None selecting the whole value
+    '''
+
+    def parse_list(i):
+        mask = {}
+        while i < len(text):
+            start = i
+            while i < len(text) and text[i] not in ',()/':
+                i += 1
+            name = text[start:i].strip()
+            if i < len(text) and text[i] == '/':
+                sub, i = parse_list_one(i + 1)
+            elif i < len(text) and text[i] == '(':
+                sub, i = parse_list(i + 1)
+                i += 1
+            else:
+                sub = None
+            mask[name] = merge(mask.get(name, {}), sub) if name in mask else sub
+            if i < len(text) and text[i] == ',':
+                i += 1
+                continue
+            return mask, i
+        return mask, i
+
+    def parse_list_one(i):
+        ''' the rest of a/b/c, one field '''
+        start = i
+        while i < len(text) and text[i] not in ',()/':
+            i += 1
+        name = text[start:i].strip()
+        if i < len(text) and text[i] == '/':
+            sub, i = parse_list_one(i + 1)
+        elif i < len(text) and text[i] == '(':
+            sub, i = parse_list(i + 1)
+            i += 1
+        else:
+            sub = None
+        return {name: sub}, i
+
+    def merge(a, b):
+        if a is None or b is None:
+            return None
+        merged = dict(a)
+        for k, v in b.items():
+            merged[k] = merge(merged[k], v) if k in merged else v
+        return merged
+
+    return parse_list(0)[0]
+
+def select_fields(value, mask):
+    if mask is None:
+        return value
+    if isinstance(value, list):
+        return [select_fields(v, mask) for v in value]
+    if isinstance(value, dict):
+        return {k: select_fields(value[k], m) for k, m in mask.items() if k in value}
+    return value
+
+def page(items, page_token, page_size, sizes):
+    ''' A page of items and the token of the next, the page size clamped like the API '''
+
+    default, maximum = sizes
+    try:
+        page_size = min(maximum, int(page_size or default)) or default
+    except ValueError:
+        page_size = default
+    start = int(page_token or 0)
+    end = start + page_size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, without this each response waits on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def api(self):
+        return self.server.api
+
+    def read_body(self):
+        length = self.headers.get('Content-Length')
+        if length:
+            return self.rfile.read(int(length))
+
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if not size:
+                    # trailers, up to the blank line
+                    while self.rfile.readline().strip():
+                        pass
+                    return b''.join(body)
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+
+        return b''
+
+    def send(self, status, body=b'', headers=None):
+        headers = dict(headers or {})
+        if not isinstance(body, bytes):
+            fields = parse_qs(urlparse(self.path).query).get('fields')
+            if fields:
+                body = select_fields(body, parse_fields(fields[0]))
+            body = json.dumps(body).encode()
+            if 'gzip' in self.headers.get('User-Agent', '') and \
+                    'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+        with self.api.lock:
+            self.api.bytes_sent += len(body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, message):
+        self.send(status, {'error': {'code': status, 'message': message}})
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        endpoint = url.path.rsplit('/', 1)[-1]
+        if endpoint.endswith(':batchAddMediaItems'):
+            # albums/{albumId}:batchAddMediaItems
+            query['albumId'], endpoint = endpoint.split(':')
+            endpoint = 'albums:' + endpoint
+
+        started = time.monotonic()
+        body = self.read_body()
+        self.api.count('{} {}'.format(method, endpoint))
+
+        if endpoint == 'uploads':
+            name = self.headers.get('X-Goog-Upload-File-Name')
+            if name:
+                with self.api.lock:
+                    self.api.upload_started.setdefault(name, started)
+            self.api.transfer(len(body))
+            with self.api.lock:
+                self.api.bytes_received += len(body)
+
+        if self.api.latency:
+            time.sleep(self.api.latency)
+
+        if self.api.should_fail():
+            return self.send(503, {'error': {'code': 503, 'message': 'Service unavailable'}},
+                    {'Retry-After': '0'})
+
+        try:
+            handler = getattr(self, '{}_{}'.format(method, endpoint.replace(':', '_')))
+        except AttributeError:
+            return self.error(404, 'Not found: {} {}'.format(method, url.path))
+
+        try:
+            handler(query, body)
+        except (KeyError, ValueError) as e:
+            self.error(400, 'Bad request: {}'.format(e))
+
+    def do_GET(self):
+        self.handle_request('get')
+
+    def do_POST(self):
+        self.handle_request('post')
+
+    def get_albums(self, query, body):
+        albums = self.api.album_list(query.get('excludeNonAppCreatedData', '').lower() == 'true')
+        albums, next_page = page(albums, query.get('pageToken'), query.get('pageSize'), ALBUMS_PAGE_SIZE)
+        resp = {}
+        if albums:
+            resp['albums'] = albums
+        if next_page:
+            resp['nextPageToken'] = next_page
+        self.send(200, resp)
+
+    def post_albums(self, query, body):
+        title = json.loads(body)['album']['title']
+        album = self.api.add_album(title)
+        self.send(200, album)
+
+    def post_uploads(self, query, body):
+        command = self.headers.get('X-Goog-Upload-Command', '')
+        if self.headers.get('X-Goog-Upload-Protocol') == 'resumable' and command == 'start':
+            return self.start_resumable()
+        if 'upload_id' in query:
+            return self.resume(query['upload_id'], command, body)
+
+        self.send(200, self.upload_token(self.headers['X-Goog-Upload-File-Name'], len(body)).encode())
+
+    def upload_token(self, name, size):
+        token = self.api.next_id('token')
+        with self.api.lock:
+            self.api.tokens[token] = (name, size)
+        return token
+
+    def start_resumable(self):
+        upload_id = self.api.next_id('upload')
+        with self.api.lock:
+            self.api.resumable[upload_id] = {
+                'name': self.headers['X-Goog-Upload-File-Name'],
+                'size': int(self.headers['X-Goog-Upload-Raw-Size']),
+                'received': 0,
+            }
+        host, port = self.server.server_address[:2]
+        self.send(200, headers={
+            'X-Goog-Upload-URL': 'http://{}:{}/v1/uploads?upload_id={}'.format(host, port, upload_id),
+            'X-Goog-Upload-Chunk-Granularity': str(CHUNK_GRANULARITY),
+            'X-Goog-Upload-Status': 'active',
+        })
+
+    def resume(self, upload_id, command, body):
+        with self.api.lock:
+            upload = self.api.resumable.get(upload_id)
+        if upload is None:
+            return self.error(404, 'No such upload')
+
+        if command == 'query':
+            return self.send(200, headers={
+                'X-Goog-Upload-Status': 'active',
+                'X-Goog-Upload-Size-Received': str(upload['received']),
+            })
+
+        offset = int(self.headers.get('X-Goog-Upload-Offset', 0))
+        if offset != upload['received']:
+            return self.error(400, 'Offset {} does not match {} received'.format(offset, upload['received']))
+        upload['received'] += len(body)
+
+        if 'finalize' in command:
+            with self.api.lock:
+                del self.api.resumable[upload_id]
+            token = self.upload_token(upload['name'], upload['received'])
+            return self.send(200, token.encode(), {'X-Goog-Upload-Status': 'final'})
+
+        self.send(200, headers={'X-Goog-Upload-Status': 'active'})
+
+    def post_mediaItems_batchCreate(self, query, body):
+        request = json.loads(body)
+        album_id = request.get('albumId')
+        if album_id not in self.api.items:
+            return self.error(400, 'No such album: {}'.format(album_id))
+
+        results = []
+        for new_item in request['newMediaItems']:
+            token = new_item['simpleMediaItem']['uploadToken']
+            with self.api.lock:
+                upload = self.api.tokens.pop(token, None)
+            if upload is None:
+                results.append({'uploadToken': token,
+                        'status': {'code': 3, 'message': 'Invalid upload token'}})
+                continue
+
+            name, size = upload
+            creation_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            mime_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            item = self.api.add_media_item(album_id, name, mime_type, creation_time)
+            with self.api.lock:
+                self.api.created[name] = time.monotonic()
+            results.append({'uploadToken': token, 'status': {'message': 'Success'}, 'mediaItem': item})
+
+        self.send(200, {'newMediaItemResults': results})
+
+    def get_mediaItems(self, query, body):
+        ''' mediaItems:list, by the date taken, most recent first, as the library is shown, not by upload '''
+        with self.api.lock:
+            items = sorted(self.api.library.values(), key=lambda item: item['mediaMetadata']['creationTime'],
+                    reverse=True)
+        items, next_page = page(items, query.get('pageToken'), query.get('pageSize'), SEARCH_PAGE_SIZE)
+        resp = {}
+        if items:
+            resp['mediaItems'] = items
+        if next_page:
+            resp['nextPageToken'] = next_page
+        self.send(200, resp)
+
+    def post_albums_batchAddMediaItems(self, query, body):
+        album_id = query['albumId']
+        media_item_ids = json.loads(body)['mediaItemIds']
+        if album_id not in self.api.items:
+            return self.error(400, 'No such album: {}'.format(album_id))
+        if not 0 < len(media_item_ids) <= 50:
+            return self.error(400, 'Request must have between 1 and 50 media item ids')
+        with self.api.lock:
+            # one bad id fails the whole call, as with the real API
+            missing = [i for i in media_item_ids if i not in self.api.library]
+            if not missing:
+                in_album = {item['id'] for item in self.api.items[album_id]}
+                self.api.items[album_id].extend(self.api.library[i] for i in media_item_ids if i not in in_album)
+        if missing:
+            return self.error(400, 'Request contains an invalid media item id: {}'.format(missing[0]))
+        self.send(200, {})
+
+    def post_mediaItems_search(self, query, body):
+        request = json.loads(body)
+        with self.api.lock:
+            items = list(self.api.items[request['albumId']])
+        items, next_page = page(items, request.get('pageToken'), request.get('pageSize'), SEARCH_PAGE_SIZE)
+        resp = {}
+        if items:
+            resp['mediaItems'] = items
+        if next_page:
+            resp['nextPageToken'] = next_page
+        self.send(200, resp)
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -1,22 +1,35 @@
 '''Retrieve google photos/videos metatdata'''
 
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
-from dateutil.relativedelta import relativedelta
 import json
 import logging
 import mimetypes
 from pathlib import Path
 import sys
+import time
 
-import arrow
-import ffmpeg
-from PIL import Image
-from PIL.ExifTags import TAGS
-
-from utils import album_contents, setup
+# arrow, ffmpeg and PIL are imported where they are used, upload.py --dry-run and --help need none of them
+from utils import album_contents, metrics, setup
+from utils.scheduler import RequestScheduler, ScheduledSession
 now = datetime.now()
 
 LOG_LEVEL = logging.INFO
+PROBE_AHEAD = 8
+
+MAGIC = [
+    (b'\xff\xd8\xff', 'image'),              # jpeg
+    (b'\x89PNG', 'image'),
+    (b'GIF8', 'image'),
+    (b'II*\x00', 'image'),                    # tiff, and raw formats based on it
+    (b'MM\x00*', 'image'),
+    (b'BM', 'image'),
+    (b'\x1aE\xdf\xa3', 'video'),              # matroska, webm
+    (b'\x00\x00\x01\xba', 'video'),          # mpeg program stream
+    (b'0&\xb2u\x8ef\xcf\x11', 'video'),       # asf, wmv
+]
+HEIF_BRANDS = (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1', b'avif', b'avis')
 
 class MediaOnDisk:
     '''
@@ -31,6 +44,7 @@ class MediaOnDisk:
         self.mime_type = ''
         self.stat = path_obj.stat() 
         self.ffmpeg_creation = None
+        self.kind = None
 
     def __repr__(self):
         return '{}'.format(self.path_obj.name)
@@ -54,12 +68,15 @@ class MediaOnDisk:
     def exif_ts(self, tz='Europe/London'):
         r = None
         if self.exif_datetime:
+            import arrow
             d = arrow.get('{} {}'.format(self.exif_datetime, tz), 'YYYY:MM:DD HH:mm:ss ZZZ')
             r = d.datetime
 
         return r
         
 def get_labeled_exif(exif):
+    from PIL.ExifTags import TAGS
+
     labeled = {}
     for (key, val) in exif.items():
         labeled[TAGS.get(key)] = val
@@ -67,6 +84,8 @@ def get_labeled_exif(exif):
     return labeled
 
 def get_exif(filename):
+    from PIL import Image
+
     exif = None
     try:
         image = Image.open(filename)
@@ -77,145 +96,318 @@ def get_exif(filename):
 
     return exif
 
-def compare_media(args, posix_path, media_items):
-    media_match = False
-    media_exists_in_album = False
+def sniff_media_kind(path, mime=None):
+    '''
+    'image', 'video' or None, from the file's magic bytes, or else its guessed mimetype
+    '''
 
     try:
-        media_on_disk = MediaOnDisk(posix_path)
-        logging.debug('Path of media on disk: {}'.format(media_on_disk.path_obj))
-        mime, encoding = mimetypes.guess_type('{}'.format(media_on_disk.path_obj))
-        logging.debug(mime)
-        media_on_disk.mime_type = mime
+        with open(path, 'rb') as f:
+            head = f.read(16)
+    except OSError:
+        head = b''
+
+    for magic, kind in MAGIC:
+        if head.startswith(magic):
+            return kind
+
+    # RIFF container: WEBP image or AVI video
+    if head[:4] == b'RIFF':
+        if head[8:12] == b'WEBP':
+            return 'image'
+        if head[8:12] == b'AVI ':
+            return 'video'
+
+    # ISO base media: HEIF/AVIF images, otherwise mp4, mov, 3gp ...
+    if head[4:8] == b'ftyp':
+        if head[8:12] in HEIF_BRANDS:
+            return 'image'
+        return 'video'
+    if head[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip'):
+        return 'video'
+
+    if mime:
+        if mime.startswith('image/'):
+            return 'image'
+        if mime.startswith('video/'):
+            return 'video'
+
+    return None
+
+def probe_media(posix_path, fallback=False):
+    '''
+    Read the mimetype, exif and ffmpeg creation time of a file on disk.
+    Images are only read for exif, videos only probed by ffmpeg, unless fallback
+    and the first found no timestamp.  Files of unknown kind get both.
+    Everything returned is picklable, so this can run in a worker process, see probe_files
+    '''
 
-        # Google registers webm as mp4, adjusting here
-        if media_on_disk.mime_type in ['video/webm', 'video/x-matroska']:
+    media_on_disk = MediaOnDisk(posix_path)
+    logging.debug('Path of media on disk: {}'.format(media_on_disk.path_obj))
+    mime, encoding = mimetypes.guess_type('{}'.format(media_on_disk.path_obj))
+    logging.debug(mime)
+    media_on_disk.mime_type = mime
 
-            logging.info('''| Comparing {:<20} to G's video/mp4 | {}'''.format(
-                media_on_disk.mime_type, media_on_disk))
+    # Google registers webm as mp4, adjusting here
+    if media_on_disk.mime_type in ['video/webm', 'video/x-matroska']:
 
-            media_on_disk.mime_type = 'video/mp4'
+        logging.info('''| Comparing {:<20} to G's video/mp4 | {}'''.format(
+            media_on_disk.mime_type, media_on_disk))
 
-        if not media_on_disk.mime_type and \
-                media_on_disk.path_obj.suffix == '.m4v':
+        media_on_disk.mime_type = 'video/mp4'
 
-            logging.info('''| Comparing {:<20} to G's video/mp4 | {}'''.format(
-                '.m4v', media_on_disk))
+    if not media_on_disk.mime_type and \
+            media_on_disk.path_obj.suffix == '.m4v':
 
-            media_on_disk.mime_type = 'video/mp4'
+        logging.info('''| Comparing {:<20} to G's video/mp4 | {}'''.format(
+            '.m4v', media_on_disk))
 
+        media_on_disk.mime_type = 'video/mp4'
 
-        logging.debug('media on disk mime type: {}'.format(media_on_disk.mime_type))
 
-        exif = get_exif(media_on_disk.path_obj)
-        logging.debug('exif: {}'.format(exif))
-        if exif:
-            labeled = get_labeled_exif(exif)
-            media_on_disk.exif_datetime = labeled.get('DateTime', '')
-            logging.debug(media_on_disk.exif_datetime)
-        
-        # get ffmpeg_creation
+    logging.debug('media on disk mime type: {}'.format(media_on_disk.mime_type))
+
+    media_on_disk.kind = sniff_media_kind(posix_path, mime)
+    logging.debug('media on disk kind: {}'.format(media_on_disk.kind))
+
+    if media_on_disk.kind != 'video':
+        media_on_disk.exif_datetime = get_exif_datetime(posix_path)
+
+    if media_on_disk.kind != 'image' or (fallback and not media_on_disk.exif_datetime):
+        media_on_disk.ffmpeg_creation = get_ffmpeg_creation(posix_path)
+
+    if media_on_disk.kind == 'video' and fallback and not media_on_disk.ffmpeg_creation:
+        media_on_disk.exif_datetime = get_exif_datetime(posix_path)
+
+    logging.debug('media_on_disk:{}, exif:{}, st_atime:{}, ffmpeg:{}'.format(
+        media_on_disk, media_on_disk.exif_datetime, media_on_disk.st_atime,
+        media_on_disk.ffmpeg_creation))
+
+    return media_on_disk
+
+def get_exif_datetime(posix_path):
+    datetime_str = ''
+    exif = get_exif(posix_path)
+    logging.debug('exif: {}'.format(exif))
+    if exif:
+        labeled = get_labeled_exif(exif)
+        datetime_str = labeled.get('DateTime', '')
+        logging.debug(datetime_str)
+
+    return datetime_str
+
+def get_ffmpeg_creation(posix_path):
+    import arrow
+    import ffmpeg
+
+    creation = None
+    try:
+        ff = ffmpeg.probe(posix_path.as_posix())
+        ct = ff['format']['tags']['creation_time']
+        creation = arrow.get(ct).datetime
+    except Exception as e:
+        # if this fails okay, move on
+        logging.debug(e)
+
+    return creation
+
+def probe_or_none(posix_path, fallback=False):
+    try:
+        return probe_media(posix_path, fallback)
+    except Exception as e:
+        logging.debug('Could not probe {}: {}'.format(posix_path, e))
+        return None
+
+def probe_timed(posix_path, fallback=False):
+    ''' (media_on_disk or None, seconds taken), timed where the probing runs '''
+
+    started = time.monotonic()
+    media_on_disk = probe_or_none(posix_path, fallback)
+    return media_on_disk, time.monotonic() - started
+
+def probe_files(posix_paths, workers=0, fallback=False, cache=None):
+    '''
+    Probe files ahead of the caller, yielding (posix_path, media_on_disk) in order.
+    With workers, probing runs on a process pool, up to workers * PROBE_AHEAD files ahead.
+    With a cache (utils.meta_cache.MetaCache), files unchanged since they were last probed
+    are read from the cache instead.
+    media_on_disk is None if the file could not be probed, compare_media will try again.
+    None in posix_paths, a --watch heartbeat, comes out as (None, None), after the files
+    already probed, so they are not held back until more files come.
+    '''
+
+    def cached(posix_path):
+        if cache is None:
+            return None
         try:
-            ff = ffmpeg.probe(posix_path.as_posix())
-            ct = ff['format']['tags']['creation_time']
-            aa = arrow.get(ct).datetime
-            media_on_disk.ffmpeg_creation = aa
-        except Exception as e:
-            # if this fails okay, move on
-            logging.debug(e)
-            pass
-
-        logging.debug('media_on_disk:{}, exif:{}, st_atime:{}, ffmpeg:{}'.format(
-            media_on_disk, media_on_disk.exif_datetime, media_on_disk.st_atime,
-            media_on_disk.ffmpeg_creation))
-
-        # Album contents
-        logging.debug('Album contents: {}'.format([(x.filename, x.mimetype, x.media_metadata_creation_time) for x in media_items]))
-        for mi in media_items:
-            if mi.filename == media_on_disk.path_obj.name:
-                media_exists_in_album = True
-                logging.debug('1: Found name match {}'.format(media_on_disk))
-                logging.debug("media mime on disk: {}, media mime in cloud: {}".format(media_on_disk.mime_type, mi.mimetype))
-                if media_on_disk.mime_type == mi.mimetype:
-                    logging.debug('2: Found mimetype (media on disk) match: {}'.format(media_on_disk.mime_type))
-                    # if either exif or ffmpeg creation time match
-                    if mi.creation_ts in [media_on_disk.exif_ts(args.tz),
-                                media_on_disk.ffmpeg_creation]:
-                        logging.debug('3: timestamps match G{}: exif:{} ffmpeg:{}'.format(
-                                mi.media_metadata_creation_time,
-                                media_on_disk.exif_datetime,
-                                media_on_disk.ffmpeg_creation,
-                                ))
-                        media_match = True
-
-                        logging.debug('Yes match, no upload: album, filename, mime, timestamp: {}'.format(args.photos[0]))
-                        # Used for debugging
-                        logging.debug('str: Timestamp from google: {}'.format(mi.media_metadata_creation_time))
-                        logging.debug('Timestamp, reformatted, from google: {}'.format(mi.creation_ts))
-                        logging.debug('str: Timestamp (exif) from media on disk: {}'.format(media_on_disk.exif_datetime))
-                        logging.debug('Timestamp (exif), reformatted, from media on disk: {}'.format(media_on_disk.exif_ts(args.tz)))
-                        logging.debug('str: Timestamp st_ctime from media on disk: {}'.format(media_on_disk.st_ctime))
-                        logging.debug('str: Timestamp st_atime from media on disk: {}'.format(media_on_disk.st_atime))
-                        logging.debug('str: Timestamp st_mtime from media on disk: {}'.format(media_on_disk.st_mtime))
-                        logging.debug('Timestamp st_atime from media on disk: {}'.format(media_on_disk.st_atime_ts))
-                    # if no match above, then let's look at st_atime and compare with Google's timestamp 
-                    elif args.minutes != 0:
-                        logging.debug('--min  {}'.format(args.minutes))
-
-                        # Let's at least require that at least exif or ffmpeg ts is missing, to continue
-                        missing_ts = False
-                        if not media_on_disk.exif_ts(args.tz):
-                            missing_ts = True
-                        if not media_on_disk.ffmpeg_creation:
-                            missing_ts = True
-
-                        if missing_ts:
-                            min_delta = timedelta(minutes=args.minutes)
-                            logging.debug('min_delta: {}'.format(min_delta))
-                            logging.debug('time delta: {}'.format(media_on_disk.st_atime_ts - mi.creation_ts))
-                            ts_diff = media_on_disk.st_atime_ts - mi.creation_ts
-                            if ts_diff < min_delta:
-                                logging.debug('Woo! Hoo!')
-                                logging.debug('|timestamp ok '
-                                    '| [{} > {} min] [Disk:{} G:{}] | {}'.format(
-                                        ts_diff, args.minutes,
-                                        media_on_disk.st_atime_ts, mi.creation_ts,
-                                        media_on_disk.path_obj.name,
-                                        ))
-                                media_match = True
-                            else:
-                                logging.info('| timestamp not ok '
-                                    '| [{} > {} min] [Disk:{} G:{}] | {}'.format(
-                                        ts_diff, args.minutes,
-                                        media_on_disk.st_atime_ts, mi.creation_ts,
-                                        media_on_disk.path_obj.name,
-                                        ))
-                        else:
-                            logging.info('| timestamp not ok | {:<101} | {:<5} {}'.format(
-                                "Media exif ts didn't match Google's. Try, e.g --tz America/New_York to suggest to G your media's TZ",
-                                'Path:', 
-                                media_on_disk.path_obj.name))
+            media_on_disk = MediaOnDisk(posix_path)
+        except OSError:
+            return None
+        if cache.get(media_on_disk, fallback):
+            metrics.count('probe_cached')
+            return media_on_disk
+        return None
+
+    def store(probed):
+        media_on_disk, seconds = probed
+        metrics.observe('probe', seconds, error=media_on_disk is None)
+        if cache is not None and media_on_disk is not None:
+            cache.put(media_on_disk, fallback)
+        return media_on_disk
+
+    if not workers:
+        for posix_path in posix_paths:
+            if posix_path is None:
+                yield None, None
+                continue
+            yield posix_path, cached(posix_path) or store(probe_timed(posix_path, fallback))
+        return
+
+    def result(posix_path, probed):
+        if isinstance(probed, Future):
+            return posix_path, store(probed.result())
+        return posix_path, probed
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for posix_path in posix_paths:
+            if posix_path is None:
+                while in_flight and not (isinstance(in_flight[0][1], Future) and not in_flight[0][1].done()):
+                    yield result(*in_flight.popleft())
+                yield None, None
+                continue
+
+            probed = cached(posix_path) or executor.submit(probe_timed, posix_path, fallback)
+            in_flight.append((posix_path, probed))
+            if len(in_flight) >= workers * PROBE_AHEAD:
+                yield result(*in_flight.popleft())
+
+        while in_flight:
+            yield result(*in_flight.popleft())
+
+def compare_media(args, posix_path, media_items, media_on_disk=None):
+    media_match, media_exists_in_album, reason = match_media(args, posix_path, media_items, media_on_disk)
+    return media_match, media_exists_in_album
+
+def match_media(args, posix_path, media_items, media_on_disk=None):
+    '''
+    Returns (media_match, media_exists_in_album, reason), reason is one of
+    exif, ffmpeg or atime (matched on that timestamp), not_in_album, mimetype_differs,
+    timestamp_differs, atime_differs or error
+    '''
 
-                            logging.debug('str: Timestamp from google: {}'.format(mi.media_metadata_creation_time))
-                            logging.debug('Timestamp, reformatted, from google: {}'.format(mi.creation_ts))
-                            logging.debug('str: Timestamp (exif) from media on disk: {}'.format(media_on_disk.exif_datetime))
-                            logging.debug('Timestamp (exif), reformatted from media on disk: {}'.format(media_on_disk.exif_ts(args.tz)))
-                            logging.debug('Timestamp (ffmpeg) from media on disk: {}'.format(media_on_disk.ffmpeg_creation))
+    media_match = False
+    media_exists_in_album = False
+    reason = 'error'
 
+    try:
+        if media_on_disk is None:
+            media_on_disk = probe_media(posix_path, args.probe_fallback)
+
+
+        # Album contents, indexed by filename and mimetype
+        exif_ts = media_on_disk.exif_ts(args.tz)
+        disk_ts = [exif_ts, media_on_disk.ffmpeg_creation]
+        name_matches = media_items.lookup(media_on_disk.path_obj.name)
+        if name_matches:
+            media_exists_in_album = True
+            logging.debug('1: Found name match {}'.format(media_on_disk))
+            logging.debug("media mime on disk: {}, media mime in cloud: {}".format(
+                media_on_disk.mime_type, [x.mimetype for x in name_matches]))
+            mime_matches = media_items.lookup(media_on_disk.path_obj.name, media_on_disk.mime_type)
+            if mime_matches:
+                logging.debug('2: Found mimetype (media on disk) match: {}'.format(media_on_disk.mime_type))
+                # items without a creationTime can not match on time, compare with the others
+                timed = [x for x in mime_matches if x.creation_us is not None]
+                ts_matches = [x for x in timed if x.creation_ts in disk_ts]
+                # if either exif or ffmpeg creation time match
+                if ts_matches:
+                    mi = ts_matches[0]
+                    reason = 'exif' if exif_ts and mi.creation_ts == exif_ts else 'ffmpeg'
+                    logging.debug('3: timestamps match G{}: exif:{} ffmpeg:{}'.format(
+                            mi.media_metadata_creation_time,
+                            media_on_disk.exif_datetime,
+                            media_on_disk.ffmpeg_creation,
+                            ))
+                    media_match = True
+
+                    logging.debug('Yes match, no upload: album, filename, mime, timestamp: {}'.format(args.photos[0]))
+                    # Used for debugging
+                    logging.debug('str: Timestamp from google: {}'.format(mi.media_metadata_creation_time))
+                    logging.debug('Timestamp, reformatted, from google: {}'.format(mi.creation_ts))
+                    logging.debug('str: Timestamp (exif) from media on disk: {}'.format(media_on_disk.exif_datetime))
+                    logging.debug('Timestamp (exif), reformatted, from media on disk: {}'.format(exif_ts))
+                    logging.debug('str: Timestamp st_ctime from media on disk: {}'.format(media_on_disk.st_ctime))
+                    logging.debug('str: Timestamp st_atime from media on disk: {}'.format(media_on_disk.st_atime))
+                    logging.debug('str: Timestamp st_mtime from media on disk: {}'.format(media_on_disk.st_mtime))
+                    logging.debug('Timestamp st_atime from media on disk: {}'.format(media_on_disk.st_atime_ts))
+                # if no match above, then let's look at st_atime and compare with Google's timestamp 
+                elif args.minutes != 0:
+                    logging.debug('--min  {}'.format(args.minutes))
+
+                    # Let's at least require that at least exif or ffmpeg ts is missing, to continue
+                    missing_ts = False
+                    if not exif_ts:
+                        missing_ts = True
+                    if not media_on_disk.ffmpeg_creation:
+                        missing_ts = True
+
+                    if missing_ts and timed:
+                        # of several items with the same name, compare with the closest in time
+                        mi = min(timed, key=lambda x: abs(media_on_disk.st_atime_ts - x.creation_ts))
+                        min_delta = timedelta(minutes=args.minutes)
+                        logging.debug('min_delta: {}'.format(min_delta))
+                        logging.debug('time delta: {}'.format(media_on_disk.st_atime_ts - mi.creation_ts))
+                        ts_diff = media_on_disk.st_atime_ts - mi.creation_ts
+                        if ts_diff < min_delta:
+                            logging.debug('Woo! Hoo!')
+                            logging.debug('|timestamp ok '
+                                '| [{} > {} min] [Disk:{} G:{}] | {}'.format(
+                                    ts_diff, args.minutes,
+                                    media_on_disk.st_atime_ts, mi.creation_ts,
+                                    media_on_disk.path_obj.name,
+                                    ))
+                            media_match = True
+                            reason = 'atime'
+                        else:
+                            reason = 'atime_differs'
+                            logging.info('| timestamp not ok '
+                                '| [{} > {} min] [Disk:{} G:{}] | {}'.format(
+                                    ts_diff, args.minutes,
+                                    media_on_disk.st_atime_ts, mi.creation_ts,
+                                    media_on_disk.path_obj.name,
+                                    ))
                     else:
-                        logging.debug('No match, upload: filename:ok, mimetype:ok, timestamp:not_okay: {}'.format(args.photos[0]))
+                        mi = (timed or mime_matches)[0]
+                        reason = 'timestamp_differs'
+                        logging.info('| timestamp not ok | {:<101} | {:<5} {}'.format(
+                            "Media exif ts didn't match Google's. Try, e.g --tz America/New_York to suggest to G your media's TZ",
+                            'Path:', 
+                            media_on_disk.path_obj.name))
 
-                        # Used for debugging
-                        logging.debug('Timestamp from google: {}'.format(mi.media_metadata_creation_time))
-                        logging.debug('Timestamp (exif) from media on disk: {}'.format(media_on_disk.exif_datetime))
+                        logging.debug('str: Timestamp from google: {}'.format(mi.media_metadata_creation_time))
+                        logging.debug('str: Timestamp (exif) from media on disk: {}'.format(media_on_disk.exif_datetime))
+                        logging.debug('Timestamp (exif), reformatted from media on disk: {}'.format(exif_ts))
                         logging.debug('Timestamp (ffmpeg) from media on disk: {}'.format(media_on_disk.ffmpeg_creation))
-                        logging.debug('Timestamp st_ctime from media on disk: {}'.format(media_on_disk.st_ctime))
-                        logging.debug('Timestamp st_atime from media on disk: {}'.format(media_on_disk.st_atime))
-                        logging.debug('Timestamp st_mtime from media on disk: {}'.format(media_on_disk.st_mtime))
 
-                break
+                else:
+                    mi = mime_matches[0]
+                    reason = 'timestamp_differs'
+                    logging.debug('No match, upload: filename:ok, mimetype:ok, timestamp:not_okay: {}'.format(args.photos[0]))
+
+                    # Used for debugging
+                    logging.debug('Timestamp from google: {}'.format(mi.media_metadata_creation_time))
+                    logging.debug('Timestamp (exif) from media on disk: {}'.format(media_on_disk.exif_datetime))
+                    logging.debug('Timestamp (ffmpeg) from media on disk: {}'.format(media_on_disk.ffmpeg_creation))
+                    logging.debug('Timestamp st_ctime from media on disk: {}'.format(media_on_disk.st_ctime))
+                    logging.debug('Timestamp st_atime from media on disk: {}'.format(media_on_disk.st_atime))
+                    logging.debug('Timestamp st_mtime from media on disk: {}'.format(media_on_disk.st_mtime))
+
+            else:
+                reason = 'mimetype_differs'
 
         if not media_exists_in_album:
+            reason = 'not_in_album'
             logging.debug('File Not Found in "{}" album: {}'.format(args.album_name, media_on_disk.path_obj))
         else:
             logging.debug('File Found in "{}" album: {}'.format(args.album_name, media_on_disk.path_obj))
@@ -224,7 +416,7 @@ def compare_media(args, posix_path, media_items):
         logging.error('There was an error trying to do a match {}'.format(e))
     finally:
         logging.debug('media match: {}'.format(media_match))
-        return media_match, media_exists_in_album
+        return media_match, media_exists_in_album, reason
 
 def main():
 
@@ -258,6 +450,8 @@ Exiting, --dry-run '''.format(args.photos[0]))
         if args.photos:
             try:
                 session = setup.get_authorized_session(args.auth_file, Path(args.credentials))
+                session = ScheduledSession(session, RequestScheduler(args.rate, args.max_requests,
+                        args.retries))
             except Exception as e:
                 logging.error('{}'.format(e))
                 sys.exit('''
@@ -266,16 +460,14 @@ Exiting, --dry-run '''.format(args.photos[0]))
 
             posix_path = Path(args.photos[0])
 
-            album_list = album_contents.get_albums(session, True)
-            for a in album_list:
-                if a['title'].lower() == args.album_name.lower():
-                    existing_album = a
-                    break
+            catalog = album_contents.AlbumCatalog(session)
+            existing_album = catalog.find(args.album_name)
 
             if existing_album:
                 album_content_generator = album_contents.get_album_contents(
                         session, existing_album)
-                album_content_details = album_contents.parse_media_items(album_content_generator)
+                album_content_details = album_contents.MediaIndex(
+                        album_contents.parse_media_items(album_content_generator))
                 media_match, media_exists_in_album = compare_media(args, posix_path, album_content_details)
                 print('')
                 logging.info(' | {:<16} {:<5} | {:<5} {:<5} | {:<5} {}'.format(
@@ -305,6 +497,7 @@ if __name__ == '__main__':
   
     finally:
   
+        from dateutil.relativedelta import relativedelta
         end = datetime.now()
         elapsed = relativedelta(end, now)
         print("""
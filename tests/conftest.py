@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the scripts and utils are imported from the top of the repository, as upload.py does
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import probe_meta
+from utils.album_contents import EPOCH, Media, MediaIndex, parse_creation_time
+
+def test_round_trip():
+    items = [Media('image/jpeg', 'a.jpg', 1579082400000000),
+            Media('video/mp4', 'b.mp4', 1579082400123456),
+            Media('image/heic', 'c.heic', 0)]
+    index = MediaIndex(items)
+
+    assert len(index) == 3
+    for media in items:
+        found = index.lookup(media.filename)
+        assert [(m.mimetype, m.filename, m.creation_us) for m in found] == \
+                [(media.mimetype, media.filename, media.creation_us)]
+    assert sorted(m.filename for m in index) == ['a.jpg', 'b.mp4', 'c.heic']
+
+def test_same_filename():
+    index = MediaIndex([Media('image/jpeg', 'a.jpg', 1), Media('image/png', 'a.jpg', 2),
+            Media('image/jpeg', 'a.jpg', 3)])
+
+    assert len(index) == 3
+    assert [m.creation_us for m in index.lookup('a.jpg')] == [1, 2, 3]
+    assert [m.creation_us for m in index.lookup('a.jpg', 'image/jpeg')] == [1, 3]
+    assert index.lookup('a.jpg', 'video/mp4') == []
+    assert index.lookup('b.jpg') == []
+
+def test_negative_times():
+    # one microsecond before the epoch, and a photo from 1969
+    moon = parse_creation_time('1969-07-20T20:17:40Z')
+    assert moon < 0
+    index = MediaIndex([Media('image/jpeg', 'epoch.jpg', -1), Media('image/jpeg', 'moon.jpg', moon)])
+
+    assert index.lookup('epoch.jpg')[0].creation_us == -1
+    media = index.lookup('moon.jpg')[0]
+    assert media.creation_us == moon
+    assert media.media_metadata_creation_time == '1969-07-20T20:17:40Z'
+    assert media.creation_ts < EPOCH
+
+def test_mimetype_not_mixed_into_time():
+    # the mimetype id is in the low bits, a negative time must not borrow from them
+    mimetypes = ['type/{}'.format(i) for i in range(20)]
+    index = MediaIndex(Media(mimetype, 'f{}'.format(i), -i) for i, mimetype in enumerate(mimetypes))
+
+    for i, mimetype in enumerate(mimetypes):
+        media = index.lookup('f{}'.format(i))[0]
+        assert (media.mimetype, media.creation_us) == (mimetype, -i)
+
+def test_no_time():
+    index = MediaIndex([Media('image/jpeg', 'a.jpg', None), Media('image/jpeg', 'b.jpg', 5)])
+
+    media = index.lookup('a.jpg')[0]
+    assert media.creation_us is None
+    assert media.media_metadata_creation_time == ''
+    assert index.lookup('b.jpg')[0].creation_us == 5
+    assert index.by_name['a.jpg'] >> MediaIndex.MIME_BITS == MediaIndex.NO_TIME
+
+def on_disk(tmp_path, exif_datetime):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(b'')
+    media_on_disk = probe_meta.MediaOnDisk(path)
+    media_on_disk.mime_type = 'image/jpeg'
+    media_on_disk.exif_datetime = exif_datetime
+    return media_on_disk
+
+def test_match_skips_items_without_time(tmp_path):
+    args = SimpleNamespace(tz='UTC', minutes=0, photos=[str(tmp_path)], probe_fallback=False)
+    media_on_disk = on_disk(tmp_path, '2020:01:15 10:00:00')
+    taken = parse_creation_time('2020-01-15T10:00:00Z')
+
+    index = MediaIndex([Media('image/jpeg', 'a.jpg', None), Media('image/jpeg', 'a.jpg', taken)])
+    assert probe_meta.match_media(args, media_on_disk.path_obj, index, media_on_disk) == (True, True, 'exif')
+
+    index = MediaIndex([Media('image/jpeg', 'a.jpg', None)])
+    assert probe_meta.match_media(args, media_on_disk.path_obj, index, media_on_disk) == \
+            (False, True, 'timestamp_differs')
+    # comparing on st_atime too
+    args.minutes = 60
+    assert probe_meta.match_media(args, media_on_disk.path_obj, index, on_disk(tmp_path, '')) == \
+            (False, True, 'timestamp_differs')
+
+def test_parse_creation_time():
+    assert parse_creation_time('1970-01-01T00:00:00Z') == 0
+    assert parse_creation_time('2020-01-15T10:00:00.5Z') == 1579082400500000
+    assert parse_creation_time('') is None
+    assert parse_creation_time('not a time') is None
+
+# vim: ai et ts=4 sw=4 sts=4 nu
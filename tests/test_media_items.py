@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from utils.media_items import BatchCreator
+from utils.scheduler import QuotaExceeded
+
+class Response:
+
+    def __init__(self, resp):
+        self.resp = resp
+
+    def json(self):
+        return self.resp
+
+class Session:
+    ''' creates the media items of calls calls, then raises QuotaExceeded '''
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def post(self, url, body, **kwargs):
+        if not self.calls:
+            raise QuotaExceeded('used')
+        self.calls -= 1
+        tokens = [item['simpleMediaItem']['uploadToken'] for item in json.loads(body)['newMediaItems']]
+        return Response({'newMediaItemResults': [{'uploadToken': token, 'status': {'message': 'Success'},
+                'mediaItem': {'id': 'id-' + token}} for token in tokens]})
+
+def test_flush():
+    creator = BatchCreator(Session(2), 'album', max_items=2)
+    for i in range(3):
+        creator.add('f{}'.format(i), 't{}'.format(i))
+
+    results = creator.flush()
+    assert [(name, media_item['id']) for name, status, media_item, seconds in results] == \
+            [('f0', 'id-t0'), ('f1', 'id-t1'), ('f2', 'id-t2')]
+    assert len(creator) == 0
+
+def test_flush_quota_exceeded():
+    creator = BatchCreator(Session(1), 'album', max_items=2)
+    for i in range(5):
+        creator.add('f{}'.format(i), 't{}'.format(i))
+
+    results = []
+    with pytest.raises(QuotaExceeded):
+        creator.flush(results)
+    # the first batch was created, the others are pending again, in order
+    assert [name for name, status, media_item, seconds in results] == ['f0', 'f1']
+    assert creator.pending == [('f2', 't2'), ('f3', 't3'), ('f4', 't4')]
+    assert creator.time_left() is not None
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from requests.exceptions import ConnectionError
+
+from utils import scheduler
+from utils.scheduler import QuotaExceeded, RequestScheduler, retry_after_seconds, safe_to_resend
+
+API = 'https://photoslibrary.googleapis.com/v1'
+
+class Response:
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class Session:
+    ''' replies with each of outcomes in turn, a response or an exception to raise '''
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.sent = 0
+
+    def request(self, method, url, data=None, **kwargs):
+        self.sent += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+def test_retry_after_seconds():
+    assert retry_after_seconds('7') == 7
+    assert retry_after_seconds('-3') == 0
+    assert retry_after_seconds(None) is None
+    assert retry_after_seconds('soon') is None
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < retry_after_seconds(later) <= 30
+
+def test_retry_delay_honours_retry_after():
+    s = RequestScheduler(retries=3)
+    assert s.retry_delay(0, 429, '12') == 12
+    assert s.retry_delay(0, 503, '0') == 0
+    assert s.retried == 2
+
+def test_retry_delay_backoff():
+    s = RequestScheduler(retries=10, backoff=1, max_backoff=8)
+    for attempt in range(10):
+        for _ in range(20):
+            assert 0 <= s.retry_delay(attempt, 500) <= min(8, 2 ** attempt)
+
+def test_retry_delay_gives_up():
+    s = RequestScheduler(retries=2)
+    assert s.retry_delay(0, 400) is None
+    assert s.retry_delay(0, 404) is None
+    assert s.retry_delay(2, 503) is None
+    assert s.retry_delay(1, 503) is not None
+    # connection errors have no status
+    assert s.retry_delay(1) is not None
+
+def test_max_requests_counts_uploads():
+    s = RequestScheduler(max_requests=3)
+    s.acquire(API + '/albums')
+    s.acquire(API + '/uploads')
+    s.acquire(API + '/uploads?upload_id=1')
+    with pytest.raises(QuotaExceeded):
+        s.acquire(API + '/uploads')
+    assert s.used == {'api': 3, 'uploads': 2}
+
+def test_no_max_requests():
+    s = RequestScheduler(max_requests=0)
+    for _ in range(100):
+        s.acquire(API + '/mediaItems:search')
+    assert s.used['api'] == 100
+
+def test_daily_reset(monkeypatch):
+    monkeypatch.setattr(scheduler, 'quota_day', lambda: 1)
+    s = RequestScheduler(max_requests=1)
+    s.acquire(API + '/albums')
+    with pytest.raises(QuotaExceeded):
+        s.acquire(API + '/albums')
+
+    monkeypatch.setattr(scheduler, 'quota_day', lambda: 2)
+    s.acquire(API + '/albums')
+    assert s.used == {'api': 1, 'uploads': 0}
+
+def test_safe_to_resend():
+    assert safe_to_resend('GET', API + '/albums')
+    assert safe_to_resend('POST', API + '/mediaItems:search')
+    assert safe_to_resend('POST', API + '/uploads')
+    assert safe_to_resend('POST', API + '/uploads?upload_id=1')
+    assert not safe_to_resend('POST', API + '/albums')
+    assert not safe_to_resend('POST', API + '/mediaItems:batchCreate')
+    assert not safe_to_resend('POST', API + '/albums/1:batchAddMediaItems')
+
+def test_request_retries_status():
+    s = RequestScheduler(backoff=0)
+    session = Session(Response(503), Response(429, {'Retry-After': '0'}), Response(200))
+    assert s.request(session, 'POST', API + '/mediaItems:batchCreate').status_code == 200
+    assert session.sent == 3
+
+def test_request_resends_safe_requests_after_connection_error():
+    s = RequestScheduler(backoff=0)
+    session = Session(ConnectionError('reset'), Response(200))
+    assert s.request(session, 'GET', API + '/albums').status_code == 200
+    assert session.sent == 2
+
+def test_request_does_not_resend_create():
+    s = RequestScheduler(backoff=0)
+    session = Session(ConnectionError('reset'), Response(200))
+    with pytest.raises(ConnectionError):
+        s.request(session, 'POST', API + '/albums')
+    assert session.sent == 1
+
+# vim: ai et ts=4 sw=4 sts=4 nu
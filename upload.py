@@ -1,42 +1,186 @@
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import functools
 import io
 import json
 import logging
+import mimetypes
 import os
 from pathlib import Path
 import platform
 import sys
+import threading
+import time
 
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
 now = datetime.now()
 
 import probe_meta
-from utils import album_contents, setup
-def create_or_retrieve_album(session, album_title):
+from utils import album_contents, dedupe, media_items, metrics, setup, upload_ledger, watch
+from utils.album_cache import AlbumCache
+from utils.journal import RunJournal
+from utils.library_index import LibraryIndex
+from utils.manifest import RunManifest
+from utils.meta_cache import MetaCache
+from utils.scheduler import QuotaExceeded, RequestScheduler, ScheduledSession
+
+MB = 1024 * 1024
+RESUMABLE_ATTEMPTS = 5
+# files queued per upload worker
+UPLOAD_AHEAD = 2
+
+_worker = threading.local()
+
+def create_or_retrieve_album(session, album_title, catalog):
 
 # Find albums created by this app to see if one matches album_title
 
-    for a in album_contents.get_albums(session, True):
-        if a["title"].lower() == album_title.lower():
-            album_id = a["id"]
-            logging.info("| Uploading into EXISTING photo album -- \'{0}\'".format(album_title))
-            return album_id
+    a = catalog.find(album_title)
+    if a:
+        album_id = a["id"]
+        logging.info("| Uploading into EXISTING photo album -- \'{0}\'".format(album_title))
+        return album_id
 
 # No matches, create new album
 
     create_album_body = json.dumps({"album":{"title": album_title}})
     #print(create_album_body)
-    resp = session.post('https://photoslibrary.googleapis.com/v1/albums', create_album_body).json()
+    resp = session.post(album_contents.API_URL + '/albums', create_album_body).json()
 
     logging.debug("Server response: {}".format(resp))
 
     if "id" in resp:
         logging.info("| Uploading into NEW photo album -- \'{0}\'".format(album_title))
+        catalog.add(resp)
         return resp['id']
     else:
         logging.error("Could not find or create photo album '\{0}\'. Server Response: {1}".format(album_title, resp))
         return None
 
+class AlbumTarget:
+    '''
+    An album being uploaded into: its id, its contents indexed for comparing,
+    and the uploaded files waiting to be added to it
+    '''
+
+    def __init__(self, title, album_id, contents, batch_creator):
+        self.title = title
+        self.album_id = album_id
+        self.contents = contents
+        self.batch_creator = batch_creator
+        self.added = 0
+
+    def created(self, batch_results):
+        '''
+        Index the media items added to the album, so files compared later in the run,
+        such as a file changed again under --watch, are compared with them too
+        '''
+
+        if self.contents is None:
+            return
+        for media in album_contents.parse_media_items(media_item
+                for photo_file_name, status, media_item, seconds in batch_results
+                if media_item and status is not None and not (status.get('code') or 0) > 0):
+            self.contents.add(media)
+
+class AlbumTargets:
+    '''
+    The albums of a run, by title, case insensitive.  With open_album, get opens
+    an album when its first file comes.  Albums that could not be found
+    or created are kept as None
+    '''
+
+    def __init__(self, open_album=None):
+        self.open_album = open_album
+        self.by_title = {}
+
+    def __contains__(self, album_title):
+        return album_title.lower() in self.by_title
+
+    def __getitem__(self, album_title):
+        return self.by_title[album_title.lower()]
+
+    def __setitem__(self, album_title, target):
+        self.by_title[album_title.lower()] = target
+
+    def __iter__(self):
+        return (target for target in list(self.by_title.values()) if target is not None)
+
+    def get(self, album_title):
+        if album_title not in self:
+            self[album_title] = self.open_album(album_title)
+        return self[album_title]
+
+    def due(self):
+        return any(target.batch_creator.due() for target in self)
+
+    def time_left(self):
+        ''' seconds until the first pending batch is due, None if nothing is pending '''
+        time_left = [target.batch_creator.time_left() for target in self]
+        time_left = [t for t in time_left if t is not None]
+        return min(time_left) if time_left else None
+
+    def waiting(self):
+        ''' uploaded files not yet added '''
+        return sum(len(target.batch_creator) for target in self)
+
+def open_album(session, album_title, args, catalog, album_cache=None):
+    '''
+    Find or create the album, and read its contents, none if it was just created.
+    Returns an AlbumTarget, or None
+    '''
+
+    created = catalog.find(album_title) is None
+    album_id = create_or_retrieve_album(session, album_title, catalog)
+    if not album_id:
+        return None
+
+    if created:
+        album_content_details = album_contents.MediaIndex()
+    else:
+        album_exists, album_content_details = get_album_and_contents(session, args, catalog,
+                album_cache, album_title)
+    batch_creator = media_items.BatchCreator(session, album_id,
+            max_items=args.batch_size, max_wait=args.batch_wait)
+    return AlbumTarget(album_title, album_id, album_content_details, batch_creator)
+
+@functools.lru_cache(maxsize=None)
+def album_roots(photos):
+    ''' directories given on the command line, deepest first, so nested ones match first '''
+    roots = [Path(p) for p in photos if Path(p).is_dir()]
+    return sorted(roots, key=lambda r: len(r.parts), reverse=True)
+
+def dir_name(p):
+    ''' the name of a directory, also for '.' or a drive root '''
+    return p.name or p.resolve().name or p.anchor
+
+def album_for(args, photo_file_name):
+    '''
+    The album a file goes into: --album, or the --album-template filled in with
+    {album}: --album, {root}: name of the directory given on the command line,
+    {dir}: name of the file's directory,
+    {path}: the file's directory below the one given, or {root} for files directly in it
+    '''
+
+    if not args.album_template:
+        return args.album_name
+
+    directory = photo_file_name.parent
+    root = directory
+    for r in album_roots(tuple(args.photos)):
+        if r == directory or r in directory.parents:
+            root = r
+            break
+
+    relative = directory.relative_to(root).parts
+    album_title = args.album_template.format(
+            album=args.album_name or '',
+            root=dir_name(root),
+            dir=dir_name(directory),
+            path='/'.join(relative) if relative else dir_name(root))
+
+    return album_title.strip() or args.album_name or dir_name(root)
+
 def read_file(path, block_size=io.DEFAULT_BUFFER_SIZE):
     '''
     https://stackoverflow.com/questions/519633/lazy-method-for-reading-big-file-in-python
@@ -51,118 +195,550 @@ def read_file(path, block_size=io.DEFAULT_BUFFER_SIZE):
             else:
                 return
 
-def upload_photos(session, photo_file_list, args):
+def compare_photo(args, photo_file_name, album_content_details, media_on_disk=None, manifest=None,
+        album_title=None):
+    '''
+    Compare a file with the album contents, and log the decision.
+    Returns 'passed' (already in the album) or 'upload'
+    '''
 
-    number_added = 0
-    number_passed_on_ts = 0
-    album_id = create_or_retrieve_album(session, args.album_name)
+    media_match, media_exists_in_album, reason = probe_meta.match_media(args, photo_file_name,
+            album_content_details, media_on_disk)
 
-    # interrupt upload if an upload was requested but could not be created
-    if not album_id:
-        return number_added, number_passed_on_ts
+    logging.info('| {:<7} | {:<7} {:<4} | {:<15} {:<4} | {:<5} {}'.format(
+    'Pass' if media_match else 'Upload',
+    'In album:', str(media_exists_in_album),
+    'Timestamp Match:', str(media_match),
+    'Path:', photo_file_name))
 
-    album_exists, album_content_details = get_album_and_contents(session, args)
+    if manifest:
+        album_title = album_title or args.album_name
+        if media_match:
+            manifest.passed(photo_file_name, reason, media_exists_in_album, album=album_title)
+        else:
+            manifest.compared(photo_file_name, reason, media_exists_in_album, album=album_title)
 
-    session.headers["Content-type"] = "application/octet-stream"
-    session.headers["X-Goog-Upload-Protocol"] = "raw"
+    if media_match:
+        return 'passed'
+    return 'upload'
 
-    for photo_file_name in photo_file_list:
+def library_match(args, photo_file_name, library, media_on_disk=None):
+    '''
+    The media item of the library, in any album or none, with the file's name, mimetype,
+    and exif or ffmpeg creation time.  None if there is none.
+    Files not probed, with --skip-compare, are not looked up: probing them here,
+    one at a time on the main thread, would cost what --skip-compare saves
+    '''
 
-            try:
-                photo_file = open(photo_file_name, mode='rb')
-                photo_bytes = photo_file.read()
-            except OSError as err:
-                logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
-                continue
+    if media_on_disk is None:
+        return None
 
-            if not args.skip_compare:
-                result = media_comparison(args, [photo_file_name,],
-                        album_content_details)
-
-                if result.get(photo_file_name, None):
-                    if result[photo_file_name].get('media_match', None):
-                        logging.info('| {:<7} | {:<7} {:<4} | {:<15} {:<4} | {:<5} {}'.format(
-                        'Pass',
-                        'In album:', str(result[photo_file_name]['media_exists_in_album']),
-                        'Timestamp Match:', str(result[photo_file_name]['media_match']),
-                        'Path:', photo_file_name))
-    
-                        number_passed_on_ts += 1 
-                        continue
-                    else:
-                        logging.info('| {:<7} | {:<7} {:<4} | {:<15} {:<4} | {:<5} {}'.format(
-                        'Upload',
-                        'In album:', str(result[photo_file_name]['media_exists_in_album']),
-                        'Timestamp Match:', str(result[photo_file_name]['media_match']),
-                        'Path:', photo_file_name))
-                else:
-                    logging.error('Something odd here, skipping {}'.format(photo_file_name))
+    try:
+        media_item = library.find(photo_file_name.name, media_on_disk.mime_type,
+                [media_on_disk.exif_ts(args.tz), media_on_disk.ffmpeg_creation])
+    except Exception as e:
+        logging.info('| Library | could not look up {}: {}'.format(photo_file_name, e))
+        return None
+
+    if media_item:
+        logging.info('| {:<7} | already in the library, adding it to the album | {:<5} {}'.format(
+                'Library', 'Path:', photo_file_name))
+    return media_item
+
+def upload_photo(session, photo_file_name, args, manifest=None):
+    '''
+    Upload a single file.
+    Returns (status, upload_token), status is 'uploaded' or None (not uploaded)
+    '''
+
+    try:
+        with open(photo_file_name, mode='rb'):
+            pass
+    except OSError as err:
+        logging.error("Could not read file \'{0}\' -- {1}".format(photo_file_name, err))
+        if manifest:
+            manifest.failed(photo_file_name, 'read_error', '{}'.format(err))
+        return None, None
+
+    file_size = os.path.getsize(photo_file_name)
+    with metrics.timer('upload') as t:
+        if args.resumable_mb and file_size > args.resumable_mb * MB:
+            upload_token = upload_resumable(session, photo_file_name, args.chunk_mb * MB)
+        else:
+            upload_token = upload_raw(session, photo_file_name)
+        if upload_token:
+            t.nbytes = file_size
+        else:
+            t.error = True
+    if manifest:
+        manifest.uploaded(photo_file_name, t.seconds, t.nbytes, bool(upload_token))
+
+    if upload_token:
+        return 'uploaded', upload_token
+
+    return None, None
+
+def upload_raw(session, photo_file_name):
+    '''
+    Upload the whole file in a single request.
+    Returns the upload token, or None
+    '''
+
+    upload_headers = {
+        "Content-type": "application/octet-stream",
+        "X-Goog-Upload-Protocol": "raw",
+        "X-Goog-Upload-File-Name": photo_file_name.name,
+    }
+    try:
+        # a callable, so the scheduler can send the file again on a retry
+        upload_token = session.post(album_contents.API_URL + '/uploads',
+                data=lambda: read_file(photo_file_name), headers=upload_headers)
+        # Keep this for historical purposes
+        #upload_token = session.post('https://photoslibrary.googleapis.com/v1/uploads', photo_bytes)
+        #except OverflowError as e:
+        #except Exception as e:
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        logging.error("Even after chunking, could not upload file {}: {}".format(photo_file_name, e))
+        return None
+
+    if (upload_token.status_code == 200) and (upload_token.content):
+        return upload_token.content.decode()
+
+    logging.error("Could not upload \'{0}\'. Server Response - {1}".format(photo_file_name.name, upload_token))
+    return None
+
+def upload_resumable(session, photo_file_name, chunk_size, attempts=RESUMABLE_ATTEMPTS):
+    '''
+    Upload the file in chunks with the resumable upload protocol.
+    After a failed chunk, ask the server how much it has received and continue from there.
+    Returns the upload token, or None
+
+    https://developers.google.com/photos/library/guides/resumable-uploads
+    '''
+
+    file_size = os.path.getsize(photo_file_name)
+    mime, encoding = mimetypes.guess_type(photo_file_name.name)
+    start_headers = {
+        "Content-Length": "0",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-File-Name": photo_file_name.name,
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Raw-Size": str(file_size),
+    }
+    if mime:
+        start_headers["X-Goog-Upload-Content-Type"] = mime
+
+    try:
+        resp = session.post(album_contents.API_URL + '/uploads', headers=start_headers)
+    except QuotaExceeded:
+        raise
+    except Exception as e:
+        logging.error("Could not start resumable upload of {}: {}".format(photo_file_name, e))
+        return None
+
+    upload_url = resp.headers.get("X-Goog-Upload-URL")
+    if resp.status_code != 200 or not upload_url:
+        logging.error("Could not start resumable upload of \'{0}\'. Server Response - {1}".format(photo_file_name.name, resp))
+        return None
+
+    # chunks, except the last one, must be a multiple of the granularity
+    granularity = int(resp.headers.get("X-Goog-Upload-Chunk-Granularity", 0) or 0)
+    if granularity:
+        chunk_size = max(granularity, chunk_size - chunk_size % granularity)
+
+    offset = 0
+    failures = 0
+    with open(photo_file_name, 'rb') as f:
+        while True:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            last = offset + len(chunk) >= file_size
+            chunk_headers = {
+                "X-Goog-Upload-Command": "upload, finalize" if last else "upload",
+                "X-Goog-Upload-Offset": str(offset),
+            }
+            try:
+                resp = session.post(upload_url, data=chunk, headers=chunk_headers)
+                if resp.status_code == 200:
+                    if last:
+                        if resp.content:
+                            return resp.content.decode()
+                        logging.error("Could not upload \'{0}\', no upload token. Server Response - {1}".format(photo_file_name.name, resp))
+                        return None
+                    offset += len(chunk)
                     continue
+                logging.info('| Resumable upload of {} at offset {} failed: {}'.format(photo_file_name.name, offset, resp))
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                logging.info('| Resumable upload of {} at offset {} failed: {}'.format(photo_file_name.name, offset, e))
+
+            failures += 1
+            if failures >= attempts:
+                logging.error("Could not upload \'{0}\' after {1} attempts".format(photo_file_name.name, attempts))
+                return None
 
-            session.headers["X-Goog-Upload-File-Name"] = photo_file_name.name
+            # Ask the server what it has committed, and continue from there
+            time.sleep(failures)
             try:
-                upload_token = session.post('https://photoslibrary.googleapis.com/v1/uploads', data=read_file(photo_file_name))
-                # Keep this for historical purposes
-                #upload_token = session.post('https://photoslibrary.googleapis.com/v1/uploads', photo_bytes)
-                #except OverflowError as e:
-                #except Exception as e:
+                resp = session.post(upload_url, headers={
+                    "Content-Length": "0",
+                    "X-Goog-Upload-Command": "query"})
+                if resp.headers.get("X-Goog-Upload-Status") != "active":
+                    logging.error("Could not resume upload of \'{0}\'. Server Response - {1}".format(photo_file_name.name, resp))
+                    return None
+                offset = int(resp.headers.get("X-Goog-Upload-Size-Received", offset))
+                logging.info('| Resuming upload of {} at offset {} of {}'.format(photo_file_name.name, offset, file_size))
+            except QuotaExceeded:
+                raise
             except Exception as e:
-                logging.error("Even after chunking, could not upload file {}: {}".format(photo_file_name, e))
-                continue
+                logging.info('| Could not query upload of {}: {}'.format(photo_file_name.name, e))
 
-            if (upload_token.status_code == 200) and (upload_token.content):
-                create_body = json.dumps({"albumId":album_id, "newMediaItems":[{"description":"","simpleMediaItem":{"uploadToken":upload_token.content.decode()}}]}, indent=4)
-                resp = session.post('https://photoslibrary.googleapis.com/v1/mediaItems:batchCreate', create_body).json()
-                logging.debug("Server response mediaItems:batchCreate: {}".format(resp))
-                if "newMediaItemResults" in resp:
-                    status = resp["newMediaItemResults"][0]["status"]
-                    if status.get("code") and (status.get("code") > 0):
-                        logging.error("Could not add \'{0}\' to library -- {1}".format(photo_file_name.name, status["message"]))
-                    else:
-                        logging.info('''| {:<7} | '{}' to library and album '{}' '''.format('Added', photo_file_name.name, args.album_name))
-                        number_added += 1
-                        # Linux: Changed: st_atime and st_ctime, Unchanged: st_mtime
-                        # Windows: Changed: st_atime, Unchanged: st_mtime and st_ctime
-                        try:
-                            fn_stat = os.stat(photo_file_name)
-                            logging.debug('stat before {}'.format(fn_stat))
-                            os.utime(photo_file_name, (datetime.now().timestamp(), fn_stat.st_mtime))
-                            logging.debug('stat after {}'.format(os.stat(photo_file_name)))
-                        except Exception as e:
-                            logging.info('|Setting access time: {} | Not critical, used for comparing access times'.format(e))
-                        finally:
-                            pass
-                else:
-                    logging.error("Could not add \'{0}\' to library. Server Response -- {1}".format(photo_file_name.name, resp))
+def upload_worker(session, photo_file_name, args, manifest=None, journal=None, album_title=None):
+    '''
+    Runs in a worker thread.  requests sessions are not thread safe,
+    so each worker thread gets its own session, sharing the credentials.
+    The upload token is journaled here, as soon as it comes, so it is kept
+    even if the run stops before the main thread collects the upload
+    '''
 
-            else:
-                logging.error("Could not upload \'{0}\'. Server Response - {1}".format(photo_file_name.name, upload_token))
+    if getattr(_worker, 'session', None) is None:
+        _worker.session = setup.clone_session(session)
+
+    status, upload_token = upload_photo(_worker.session, photo_file_name, args, manifest)
+    if journal and upload_token:
+        journal.token(photo_file_name, album_title, upload_token)
+    return status, upload_token
+
+def collect_uploads(pending, targets, counts, args, ledger=None, album_cache=None, manifest=None,
+        journal=None, library=None, block=True):
+    '''
+    Wait for at least one upload to finish, or for a pending batch to be due.
+    Without block, only the uploads already finished are collected.
+    Upload tokens go to the batch of their album, which is flushed when due
+    '''
+
+    timeout = 0 if targets.due() or not block else targets.time_left()
+    done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+    for future in done:
+        photo_file_name, target = pending.pop(future)
+        status, upload_token = future.result()
+        if status == 'uploaded':
+            target.batch_creator.add(photo_file_name, upload_token)
+
+    for target in targets:
+        if target.batch_creator.due():
+            add_to_album(target, counts, args, ledger, album_cache, manifest, journal, library)
+
+def add_to_album(target, counts, args, ledger=None, album_cache=None, manifest=None, journal=None, library=None):
+    '''
+    Add the target's pending uploads, and media items found in the library, to its album,
+    counted in counts['added'].  If a quota stops it, the files of the batches sent are
+    still recorded, the others stay pending
+    '''
 
+    batch_results = []
     try:
-        del(session.headers["Content-type"])
-        del(session.headers["X-Goog-Upload-Protocol"])
-        del(session.headers["X-Goog-Upload-File-Name"])
-    except KeyError:
-        pass
+        target.batch_creator.flush(batch_results)
+    finally:
+        target.created(batch_results)
+        number_added = media_items_created(batch_results, args, ledger, album_cache,
+                manifest, target.title, journal, library)
+        target.added += number_added
+        counts['added'] += number_added
+
+def media_items_created(batch_results, args, ledger=None, album_cache=None, manifest=None,
+        album_title=None, journal=None, library=None):
+    '''
+    Log each result of mediaItems:batchCreate, or albums:batchAddMediaItems, record the
+    files added in the ledger, the manifest, the journal and the library index,
+    and update their st_atime.
+    Returns the number of files added
+    '''
 
-    return number_added, number_passed_on_ts
+    album_title = album_title or args.album_name
+    number_added = 0
+    for photo_file_name, status, media_item, seconds in batch_results:
+        if manifest:
+            manifest.created(photo_file_name, status, media_item, seconds)
+        if journal:
+            journal.created(photo_file_name, album_title, status, media_item)
+
+        if status is None:
+            # whole batchCreate call failed, already logged
+            continue
+
+        if status.get("code") and (status.get("code") > 0):
+            if status.get('library'):
+                logging.error("Could not add \'{0}\' from the library to album \'{1}\' -- {2}".format(
+                        photo_file_name.name, album_title, status.get("message")))
+                if library and media_item and media_item.get('id'):
+                    # gone from the library since it was indexed, uploaded on the next run
+                    library.forget(media_item['id'])
+            else:
+                logging.error("Could not add \'{0}\' to library -- {1}".format(photo_file_name.name, status.get("message")))
+            continue
 
-def clean_file_list(photo_file_list, args):
-    if not args.exclude:
-        return list(filter(None, photo_file_list))
+        if status.get('library'):
+            logging.info('''| {:<7} | '{}' from the library to album '{}' '''.format('Added', photo_file_name.name, album_title))
+        else:
+            logging.info('''| {:<7} | '{}' to library and album '{}' '''.format('Added', photo_file_name.name, album_title))
+        number_added += 1
+        if ledger:
+            ledger.record(photo_file_name, album_title, (media_item or {}).get('id'))
+        if album_cache and media_item:
+            album_cache.append(album_title, media_item)
+        if library and media_item:
+            library.add(media_item)
+
+        if not args.set_atime:
+            continue
+
+        # Linux: Changed: st_atime and st_ctime, Unchanged: st_mtime
+        # Windows: Changed: st_atime, Unchanged: st_mtime and st_ctime
+        try:
+            fn_stat = os.stat(photo_file_name)
+            logging.debug('stat before {}'.format(fn_stat))
+            os.utime(photo_file_name, (datetime.now().timestamp(), fn_stat.st_mtime))
+            logging.debug('stat after {}'.format(os.stat(photo_file_name)))
+        except Exception as e:
+            logging.info('|Setting access time: {} | Not critical, used for comparing access times'.format(e))
+        finally:
+            pass
+
+    if ledger:
+        ledger.commit()
+    if journal:
+        journal.commit()
+    if library:
+        library.commit()
+
+    return number_added
+
+def not_duplicate(photo_file_list, args, counts, manifest=None):
+    '''
+    With --dedupe, only the first of several files with the same content is uploaded,
+    per album with --album-template
+    '''
 
-    photo_file_list_clean = []
-    for p in photo_file_list:
-        add_to_clean = True
-        for ea in args.exclude:
-            if p.name.lower().endswith(ea.lower()):
-                add_to_clean = False
-                break
+    finders = {}
+    for photo_file_name in photo_file_list:
+        if photo_file_name is None:
+            # --watch, nothing new yet
+            yield None
+            continue
+
+        album_title = album_for(args, photo_file_name)
+        finder = finders.setdefault(album_title.lower(), dedupe.DuplicateFinder())
+        original = finder.duplicate_of(photo_file_name)
+        if original is None:
+            yield photo_file_name
+            continue
+
+        counts['attempted'] += 1
+        counts['duplicate'] += 1
+        logging.info('| {:<7} | {:<13} {} | {:<5} {}'.format(
+        'Pass',
+        'Duplicate of:', original,
+        'Path:', photo_file_name))
+        if manifest:
+            manifest.passed(photo_file_name, 'duplicate', album=album_title, duplicate_of=str(original))
+
+    logging.debug('Hashed {} bytes looking for duplicates'.format(
+            sum(finder.hashed_bytes for finder in finders.values())))
+
+def not_in_ledger(photo_file_list, args, counts, ledger=None, manifest=None):
+    for photo_file_name in photo_file_list:
+        if photo_file_name is None:
+            yield None
+            continue
+
+        counts['attempted'] += 1
+        # Unchanged since it was uploaded, no need to compare
+        album_title = album_for(args, photo_file_name)
+        if ledger and ledger.uploaded(photo_file_name, album_title):
+            logging.info('| {:<7} | {:<7} {:<4} | {:<5} {}'.format(
+            'Pass',
+            'In ledger:', 'True',
+            'Path:', photo_file_name))
+            counts['ledger'] += 1
+            if manifest:
+                manifest.passed(photo_file_name, 'ledger', True, album=album_title)
+            continue
+        yield photo_file_name
+
+def not_in_journal(photo_file_list, args, counts, journal, manifest=None):
+    ''' With --resume, pass the files the interrupted run added, or uploaded and is adding now '''
 
-        if add_to_clean:
-            photo_file_list_clean.append(p)
+    for photo_file_name in photo_file_list:
+        if photo_file_name is None:
+            yield None
+            continue
+
+        album_title = album_for(args, photo_file_name)
+        done = journal.skip(photo_file_name, album_title)
+        if done is None:
+            yield photo_file_name
+            continue
+
+        logging.info('| {:<7} | {:<7} {:<7} | {:<5} {}'.format(
+        'Pass',
+        'Journal:', done.capitalize(),
+        'Path:', photo_file_name))
+        if done == 'added':
+            counts['journal'] += 1
+            if manifest:
+                manifest.passed(photo_file_name, 'journal', True, album=album_title)
+
+def resume_uploads(targets, journal, manifest=None):
+    '''
+    With --resume, add the files the interrupted run uploaded but did not add,
+    with their journaled upload tokens.  Returns the number of files
+    '''
 
-    return list(filter(None, photo_file_list_clean))
+    resumed = 0
+    for photo_file_name, album_title, upload_token in journal.pending():
+        target = targets.get(album_title)
+        if target is None:
+            continue
+        target.batch_creator.add(photo_file_name, upload_token)
+        if manifest:
+            manifest.compared(photo_file_name, 'resumed', None, album=target.title)
+        resumed += 1
+
+    if resumed:
+        logging.info('| Journal | adding {} file(s) uploaded by the interrupted run'.format(resumed))
+    return resumed
+
+def probe_photos(photo_file_list, args, counts, ledger=None, meta_cache=None, manifest=None,
+        journal=None):
+    '''
+    Generator of (photo_file_name, media_on_disk) for the files not in the ledger,
+    nor in the journal of a resumed run, nor duplicates of an earlier file.  None in photo_file_list, while --watch waits
+    for files, comes out as (None, None).
+    Probing runs ahead of the uploads, on a process pool with --probe-workers
+    '''
+
+    if args.dedupe:
+        photo_file_list = not_duplicate(photo_file_list, args, counts, manifest)
+    photo_file_list = not_in_ledger(photo_file_list, args, counts, ledger, manifest)
+    if journal and args.resume:
+        photo_file_list = not_in_journal(photo_file_list, args, counts, journal, manifest)
+    if args.skip_compare:
+        return ((photo_file_name, None) for photo_file_name in photo_file_list)
+
+    return probe_meta.probe_files(photo_file_list,
+            args.probe_workers, args.probe_fallback, meta_cache)
+
+def upload_photos(session, photo_file_list, args, catalog=None, ledger=None, album_cache=None,
+        meta_cache=None, manifest=None, journal=None, library=None):
+    '''
+    photo_file_list can be any iterable, files are uploaded as they come.
+    Returns Counter of files 'attempted', 'added', 'passed' on timestamp, passed as already in the 'ledger'
+    or the 'journal', passed as a 'duplicate' of an earlier file, 'resumed' from the journal,
+    and added from the 'library' without uploading
+    '''
+
+    counts = Counter()
+    if catalog is None:
+        catalog = album_contents.AlbumCatalog(session)
+    targets = AlbumTargets(lambda album_title: open_album(session, album_title, args, catalog, album_cache))
+
+    # interrupt upload if an upload was requested but could not be created
+    if not args.album_template and targets.get(args.album_name) is None:
+        return counts
+
+    if journal and args.resume:
+        counts['resumed'] = resume_uploads(targets, journal, manifest)
+
+    probed = probe_photos(photo_file_list, args, counts, ledger, meta_cache, manifest, journal)
+
+    logging.debug('Uploading with {} worker(s)'.format(args.workers))
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        pending = {}
+        try:
+            try:
+                for photo_file_name, media_on_disk in probed:
+                    if photo_file_name is None:
+                        # --watch is waiting for files, finish what can be finished meanwhile
+                        collect_uploads(pending, targets, counts, args, ledger, album_cache, manifest,
+                                journal, library, block=False)
+                        continue
+
+                    album_title = album_for(args, photo_file_name)
+                    target = targets.get(album_title)
+                    if target is None:
+                        # could not find or create the album, already logged
+                        if manifest:
+                            manifest.failed(photo_file_name, 'album_error',
+                                    'could not find or create album', album=album_title)
+                        continue
+
+                    if not args.skip_compare:
+                        if compare_photo(args, photo_file_name, target.contents, media_on_disk,
+                                manifest, target.title) == 'passed':
+                            counts['passed'] += 1
+                            continue
+
+                    if library:
+                        media_item = library_match(args, photo_file_name, library, media_on_disk)
+                        if media_item:
+                            if manifest:
+                                manifest.compared(photo_file_name, 'library', False, album=target.title)
+                            target.batch_creator.add_existing(photo_file_name, media_item)
+                            counts['library'] += 1
+                            if targets.due():
+                                collect_uploads(pending, targets, counts, args, ledger, album_cache, manifest,
+                                        journal, library, block=False)
+                            continue
+
+                    pending[executor.submit(upload_worker, session, photo_file_name, args, manifest,
+                            journal, target.title)] = (photo_file_name, target)
+
+                    while len(pending) >= args.workers * UPLOAD_AHEAD or targets.due():
+                        collect_uploads(pending, targets, counts, args, ledger, album_cache, manifest,
+                                journal, library)
+            except KeyboardInterrupt:
+                if not args.watch:
+                    # uploads already running finish, their tokens journaled, queued ones are dropped
+                    executor.shutdown(cancel_futures=True)
+                    raise
+                for future in list(pending):
+                    if future.cancel():
+                        del pending[future]
+                logging.info('| Watch   | stopped, adding the {} file(s) being uploaded'.format(len(pending)))
+
+            while pending:
+                collect_uploads(pending, targets, counts, args, ledger, album_cache, manifest, journal, library)
+
+            for target in targets:
+                add_to_album(target, counts, args, ledger, album_cache, manifest, journal, library)
+        except QuotaExceeded as e:
+            executor.shutdown(cancel_futures=True)
+            # uploads finished but not collected, their tokens are journaled
+            uploaded = [future for future in pending
+                    if not future.cancelled() and future.exception() is None and future.result()[1]]
+            logging.error('Stopping, {}. {} uploaded file(s) not added to the album'.format(
+                    e, targets.waiting() + len(uploaded)))
+
+    for target in targets:
+        catalog.count_added(target.album_id, target.added)
+
+    return counts
+
+def excluded(photo_file_name, args):
+    if not args.exclude:
+        return False
+
+    name = photo_file_name.name.lower()
+    for ea in args.exclude:
+        if name.endswith(ea.lower()):
+            return True
+
+    return False
 
 def format_file_list(file_list):
         s = '' 
@@ -171,22 +747,75 @@ def format_file_list(file_list):
 
         return s.strip()
 
-def recurse_dirs(p, args, photo_file_list=[]):
-    #logging.debug('recurse: {}'.format(args.recurse))
-    #logging.debug('args: {}'.format(args))
-    #logging.debug('p: {}'.format(p))
-    if args.recurse == 'none':
-        return photo_file_list
-    if args.recurse == 'once':
-        list_dir = list(p.glob('*'))
-        #logging.debug('list_dir: {}'.format(list_dir))
-    if args.recurse == 'all':
-        list_dir = list(p.glob('**/*'))
+def walk_dir(p, recurse):
+    '''
+    Generator of the files in directory p, using os.scandir.
+    recurse 'once': files directly in p, 'all': files in p and below, 'none': nothing.
+    Symlinked directories are followed, but each directory is only visited once.
+    '''
 
-    photo_file_list.extend(
-        [pp for pp in list_dir if pp.is_file() if pp not in photo_file_list])
+    if recurse == 'none':
+        return
 
-    return photo_file_list 
+    dirs = deque([p])
+    visited = set()
+    while dirs:
+        d = dirs.popleft()
+        try:
+            st = os.stat(d)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+
+            with os.scandir(d) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            yield Path(entry.path)
+                        elif recurse == 'all' and entry.is_dir():
+                            dirs.append(entry.path)
+                    except OSError as e:
+                        logging.error('{}'.format(e))
+        except OSError as e:
+            logging.error('{}'.format(e))
+
+def iter_photo_files(photo_list, args):
+    '''
+    Generator of the files to upload, from the paths given on the command line.
+    Directories are walked as the files are consumed, so uploads can start on the first file.
+    Duplicates and --exclude extensions are dropped as they are found.
+    '''
+
+    seen = set()
+    for p in photo_list:
+        if p.is_dir():
+            candidates = metrics.timed_iter('discovery', walk_dir(p, args.recurse))
+        else:
+            candidates = [p]
+
+        for pp in candidates:
+            key = os.path.normpath(pp)
+            if key in seen or excluded(pp, args):
+                continue
+            seen.add(key)
+            yield pp
+
+def watch_photo_files(photo_list, args):
+    '''
+    With --watch: the files to upload now, then, forever, the files added to or changed
+    in the directories given, once they have settled.
+    Yields None while waiting, so uploads can be finished and batches added meanwhile
+    '''
+
+    dirs = [p for p in photo_list if p.is_dir()]
+    watcher = watch.Watcher(dirs, args.recurse, args.watch_settle, args.watch_poll)
+
+    yield from iter_photo_files(photo_list, args)
+
+    logging.info('| Watch   | {} director(ies), {}, waiting for new files'.format(len(dirs), watcher.method))
+    for photo_file_name in watcher.files():
+        if photo_file_name is None or not excluded(photo_file_name, args):
+            yield photo_file_name
 
 def dry_run_msg(photo_file_list):
 
@@ -199,35 +828,96 @@ Exiting, dry-run'''.format(format_file_list(photo_file_list), len(photo_file_lis
 
         return msg
 
-def media_comparison(args, photo_file_list, album_content_detail):
+def media_comparison(args, photo_file_list, album_content_detail, meta_cache=None):
+    '''
+    album_content_detail is the album's MediaIndex, or with --album-template, a function
+    returning the MediaIndex of an album title, None if there is no such album
+    '''
+
     results = {}
-    for ea in photo_file_list:
-        media_match, media_exists_in_album = probe_meta.compare_media(args, ea, album_content_detail)
+    for ea, media_on_disk in probe_meta.probe_files(photo_file_list,
+            args.probe_workers, args.probe_fallback, meta_cache):
+        album_title = album_for(args, ea)
+        contents = album_content_detail
+        if callable(album_content_detail):
+            contents = album_content_detail(album_title)
+
+        if contents is None:
+            media_match, media_exists_in_album, reason = False, False, 'not_in_album'
+        else:
+            media_match, media_exists_in_album, reason = probe_meta.match_media(args, ea,
+                    contents, media_on_disk)
 
         results[ea] = {'media_match': media_match,
-                       'media_exists_in_album': media_exists_in_album}
+                       'media_exists_in_album': media_exists_in_album,
+                       'reason': reason,
+                       'album': album_title}
 
     return results
 
-def get_album_and_contents(session, args):
+def get_album_and_contents(session, args, catalog=None, album_cache=None, album_title=None):
+    '''
+    Album album_title, by default --album.
+    With an album cache, the album snapshot is used unless it is stale, or --refresh-cache.
+    With --offline, only the snapshot is used, whatever its age
+    '''
+
+    album_title = album_title or args.album_name
     album_exists = False
-    album_itself = None
     album_content_details = None
 
-    album_list = album_contents.get_albums(session, True)
+    if args.offline:
+        album_itself, album_content_generator = album_cache.load(album_title)
+    else:
+        if catalog is None:
+            catalog = album_contents.AlbumCatalog(session)
+
+        album_itself = catalog.find(album_title)
+        album_content_generator = None
+        if album_itself and album_cache and not args.refresh_cache:
+            snapshot_album, album_content_generator = album_cache.load(
+                    album_title, album_cache.ttl)
+            # Album deleted and created again since the snapshot
+            if snapshot_album and snapshot_album['id'] != album_itself['id']:
+                album_content_generator = None
+
+        if album_itself and album_content_generator is None:
+            album_content_generator = album_contents.get_album_contents(
+                    session, album_itself)
+            if album_cache:
+                album_content_generator = album_cache.record(album_itself, album_content_generator)
+
+    if album_itself:
+        album_exists = True
+        album_content_details = album_contents.MediaIndex(
+                album_contents.parse_media_items(album_content_generator))
 
-    for a in album_list:
-        if a['title'].lower() == args.album_name.lower():
-            album_exists = True
-            album_itself = a
-            break
+    return album_exists, album_content_details
+
+def write_metrics(args, counts, scheduler=None):
+    '''
+    Log the time spent per phase, and write the metrics
+    with --metrics-json and --metrics-prom
+    '''
 
-    if album_exists:
-        album_content_generator = album_contents.get_album_contents(
-                session, album_itself)
-        album_content_details = album_contents.parse_media_items(album_content_generator)
+    for outcome in ('attempted', 'added', 'passed', 'ledger', 'journal', 'duplicate', 'resumed', 'library'):
+        metrics.gauge('files_{}'.format(outcome), counts[outcome])
+    if scheduler:
+        metrics.gauge('api_requests', scheduler.used['api'])
+        metrics.gauge('upload_requests', scheduler.used['uploads'])
+        metrics.gauge('retries', scheduler.retried)
+        metrics.gauge('throttled_seconds', round(scheduler.throttled, 3))
 
-    return album_exists, album_content_details
+    for line in metrics.REGISTRY.summary():
+        logging.info('| Metrics | {}'.format(line))
+
+    try:
+        if args.metrics_json:
+            metrics.REGISTRY.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.REGISTRY.write_prometheus(args.metrics_prom)
+    except OSError as e:
+        logging.error('Could not write metrics: {}'.format(e))
 
     
 def main():
@@ -246,16 +936,10 @@ def main():
         logging.basicConfig(filename=args.log_file, level=LOG_LEVEL)
 
     logging.debug('args: {}'.format(args))
-    photo_file_list = []
     photo_list = [Path(p) for p in args.photos]
     try:
         for p in photo_list:
-            if p.is_file():
-                if p not in photo_file_list:
-                    photo_file_list.append(p)
-            elif p.is_dir():
-                photo_file_list = recurse_dirs(p, args, photo_file_list)
-            else:
+            if not (p.is_file() or p.is_dir()):
                logging.error('''
 
 This item is NOT a file or directory: {}
@@ -267,61 +951,133 @@ Exiting ...
          logging.error('Exiting ...')
          sys.exit()
 
-    photo_file_list = clean_file_list(photo_file_list, args)
+    if args.watch:
+        photo_file_list = watch_photo_files(photo_list, args)
+    else:
+        photo_file_list = iter_photo_files(photo_list, args)
 
     if args.dry_run:
-        msg = dry_run_msg(photo_file_list)
+        msg = dry_run_msg(list(photo_file_list))
         print(msg)
 
         sys.exit()
         
     #logging.debug('photo_file_list: {}:'.format(photo_file_list))
 
-    session = setup.get_authorized_session(args.auth_file, Path(args.credentials))
-    logging.debug("Session set up, now uploading ... ")
+    album_cache = None
+    if args.cache_dir:
+        album_cache = AlbumCache(args.cache_dir, args.cache_ttl)
 
+    session = None
+    scheduler = None
+    catalog = None
+    if not args.offline:
+        session = setup.get_authorized_session(args.auth_file, Path(args.credentials))
+        scheduler = RequestScheduler(args.rate, args.max_requests, args.retries)
+        session = ScheduledSession(session, scheduler)
+        catalog = album_contents.AlbumCatalog(session)
+        logging.debug("Session set up, now uploading ... ")
 
-    if args.stat_times:
-        album_exists, album_content_details = get_album_and_contents(session, args)
-        if album_exists:
-            result = media_comparison(args, photo_file_list,
-                    album_content_details)
-            if result:
-                #logging.debug('{}'.format(result))
-                for ea in result.keys():
-                    logging.info('|{:<16} {:<5} | {:<16} {:<5} | {:<5} {}'.format(
-                    'Exists in album:', str(result[ea]['media_exists_in_album']),
-                    'Timestamp Match:', str(result[ea]['media_match']),
-                    'Path:', ea))
 
-            sys.exit()
-        else:
-            logging.info('''
+    meta_cache = None
+    if args.meta_cache:
+        meta_cache = MetaCache(args.meta_cache)
+
+    manifest = None
+    if args.manifest:
+        manifest = RunManifest(args.manifest)
+
+    counts = Counter()
+    try:
+        if args.stat_times:
+            if args.album_template:
+                album_exists = True
+                album_content_details = functools.lru_cache(maxsize=None)(
+                        lambda album_title: get_album_and_contents(session, args, catalog, album_cache, album_title)[1])
+            else:
+                album_exists, album_content_details = get_album_and_contents(session, args, catalog, album_cache)
+            if album_exists:
+                result = media_comparison(args, photo_file_list,
+                        album_content_details, meta_cache)
+                if result:
+                    #logging.debug('{}'.format(result))
+                    for ea in result.keys():
+                        logging.info('|{:<16} {:<5} | {:<16} {:<5} | {:<5} {}'.format(
+                        'Exists in album:', str(result[ea]['media_exists_in_album']),
+                        'Timestamp Match:', str(result[ea]['media_match']),
+                        'Path:', ea))
+                        if manifest:
+                            manifest.write(ea, 'pass' if result[ea]['media_match'] else 'upload',
+                                    reason=result[ea]['reason'], in_album=result[ea]['media_exists_in_album'],
+                                    album=result[ea]['album'])
+
+                sys.exit()
+            else:
+                logging.info('''
 Album "{}" does not exist, so no comparison is possible!
 Exiting ...'''.format(args.album_name))
 
-        sys.exit()
+            sys.exit()
 
-    # Okay, let's get to work
-    number_added, number_passed_on_ts = upload_photos(session, photo_file_list, args)
+        # Okay, let's get to work
+        ledger = None
+        if args.ledger:
+            ledger = upload_ledger.UploadLedger(args.ledger)
+        journal = None
+        if args.journal:
+            journal = RunJournal(args.journal, args.resume)
+        library = None
+        if args.library_index:
+            library = LibraryIndex(args.library_index)
+
+        try:
+            if library:
+                library.refresh(session, args.refresh_library, args.library_ttl * 3600)
+
+            uploader = upload_photos
+            if args.backend == 'async':
+                import upload_async
+                uploader = upload_async.upload_photos
+
+            counts = uploader(session, photo_file_list, args, catalog, ledger, album_cache,
+                    meta_cache, manifest, journal, library)
+        finally:
+            if ledger:
+                ledger.close()
+            if journal:
+                journal.close()
+            if library:
+                library.close()
+    finally:
+        if meta_cache:
+            if args.evict_meta_cache:
+                meta_cache.evict()
+            meta_cache.close()
+        if manifest:
+            manifest.close()
+        if scheduler:
+            logging.info('| Quota   | {}'.format(scheduler.report()))
+        write_metrics(args, counts, scheduler)
 
     # As a quick status check, dump the albums and their key attributes
 
     logging.info("|{:<50} | {:>8} | {} ".format("PHOTO ALBUM","# PHOTOS", "IS WRITEABLE?"))
 
-    for a in album_contents.get_albums(session):
-        print("{:<50} | {:>8} | {} ".format(a["title"],a.get("mediaItemsCount", "0"), str(a.get("isWriteable", False))))
+    try:
+        for a in catalog.albums():
+            print("{:<50} | {:>8} | {} ".format(a["title"],a.get("mediaItemsCount", "0"), str(a.get("isWriteable", False))))
+    except QuotaExceeded as e:
+        # uploads count towards --max-requests too, so it may be used up by now
+        logging.error('Not listing albums, {}'.format(e))
 
-    return photo_file_list, number_added, number_passed_on_ts
+    return counts
 
 if __name__ == '__main__':
-    photo_file_list = []
-    number_added = 0
-    number_passed_on_ts = 0
+    counts = Counter()
     print_times = False
   
     try:
-        photo_file_list, number_added, number_passed_on_ts = main()
+        counts = main()
         print_times = True
     except KeyboardInterrupt:
         logging.error('''
@@ -329,16 +1085,24 @@ if __name__ == '__main__':
           Keyboard interrupt : ) exiting
   
           ''')
+    except QuotaExceeded as e:
+        logging.error('Stopping, {}'.format(e))
   
     finally:
   
         if print_times:
+            from dateutil.relativedelta import relativedelta
             end = datetime.now()
             elapsed = relativedelta(end, now)
             print('')
-            print('{:<50} | {}'.format('Number of files added', number_added))
-            print('{:<50} | {}'.format('Number of files, not added, based on timestamp', number_passed_on_ts))
-            print('{:<50} | {}'.format('Number of files attempted', len(photo_file_list)))
+            print('{:<50} | {}'.format('Number of files added', counts['added']))
+            print('{:<50} | {}'.format('Number of files, not added, based on timestamp', counts['passed']))
+            print('{:<50} | {}'.format('Number of files, not added, found in ledger', counts['ledger']))
+            print('{:<50} | {}'.format('Number of files, not added, found in journal', counts['journal']))
+            print('{:<50} | {}'.format('Number of files, not added, duplicates', counts['duplicate']))
+            print('{:<50} | {}'.format('Number of files, added from journal, not uploaded', counts['resumed']))
+            print('{:<50} | {}'.format('Number of files, added from library, not uploaded', counts['library']))
+            print('{:<50} | {}'.format('Number of files attempted', counts['attempted']))
             print('{:<50} | {} hours, {} minutes, {} seconds'.format('Time elapsed', elapsed.hours, elapsed.minutes, elapsed.seconds))
   
 # vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,566 @@
+'''
+asyncio upload backend, selected with --backend async.
+
+Uses the credentials of setup.get_authorized_session with a pooled aiohttp session,
+so album listing, byte uploads and mediaItems:batchCreate calls run concurrently,
+at most --concurrency requests at a time.  Comparing, the ledger and the caches
+are shared with the synchronous path in upload.py.
+'''
+
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import logging
+import mimetypes
+import os
+import time
+
+import upload
+from utils import album_contents, media_items, metrics, setup
+from utils.scheduler import QuotaExceeded, safe_to_resend
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# returned by next() once the files run out, (None, None) is a --watch heartbeat
+DONE = object()
+
+class AsyncPhotosClient:
+    ''' The few Google Photos Library API calls used for uploading, on aiohttp '''
+
+    def __init__(self, credentials, concurrency=8, scheduler=None):
+        self.credentials = credentials
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.refresh_lock = asyncio.Lock()
+        self.http = None
+
+    async def __aenter__(self):
+        self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                headers={'User-Agent': setup.USER_AGENT, 'Accept-Encoding': 'gzip'})
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.http.close()
+
+    async def auth_headers(self):
+        async with self.refresh_lock:
+            if not self.credentials.valid:
+                from google.auth.transport.requests import Request
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.credentials.refresh, Request())
+
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    async def request(self, method, url, headers=None, data=None, **kwargs):
+        '''
+        returns (status, body bytes, response headers)
+        With a scheduler (utils.scheduler.RequestScheduler), requests are rate limited,
+        counted and retried.  data may be a callable returning the body
+        '''
+
+        attempt = 0
+        while True:
+            if self.scheduler:
+                await asyncio.sleep(self.scheduler.acquire(url))
+            retry = None
+            try:
+                async with self.semaphore:
+                    request_headers = await self.auth_headers()
+                    request_headers.update(headers or {})
+                    async with self.http.request(method, url, headers=request_headers,
+                            data=data() if callable(data) else data, **kwargs) as resp:
+                        status, body = resp.status, await resp.read()
+                        if self.scheduler:
+                            retry = self.scheduler.retry_delay(attempt, status, resp.headers.get('Retry-After'))
+                        if retry is None:
+                            return status, body, resp.headers
+                        logging.info('| Retry   | {} {} in {:.1f}s: {}'.format(method, url, retry, status))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if self.scheduler and safe_to_resend(method, url):
+                    retry = self.scheduler.retry_delay(attempt)
+                if retry is None:
+                    raise
+                logging.info('| Retry   | {} {} in {:.1f}s: {}'.format(method, url, retry, e))
+
+            await asyncio.sleep(retry)
+            attempt += 1
+
+    async def request_json(self, method, url, phase=None, **kwargs):
+        ''' phase, if given, is the utils.metrics phase the request is timed in '''
+
+        started = time.monotonic()
+        status, body, _ = await self.request(method, url, **kwargs)
+        try:
+            resp = json.loads(body)
+        except ValueError:
+            resp = {'error': {'code': status, 'message': body.decode(errors='replace')}}
+        if phase:
+            metrics.observe(phase, time.monotonic() - started, len(body), 'error' in resp)
+        return resp
+
+    async def albums(self, appCreatedOnly=False):
+        params = {'excludeNonAppCreatedData': 'true' if appCreatedOnly else 'false',
+                'pageSize': album_contents.ALBUMS_PAGE_SIZE, 'fields': album_contents.ALBUM_FIELDS}
+        albums = []
+        while True:
+            resp = await self.request_json('GET', album_contents.API_URL + '/albums', 'album_list',
+                    params=params)
+            albums.extend(resp.get('albums', []))
+            if 'albums' in resp and 'nextPageToken' in resp:
+                params['pageToken'] = resp['nextPageToken']
+            else:
+                return albums
+
+    async def batch_add(self, album_id, add_body):
+        started = time.monotonic()
+        try:
+            return await self.request_json('POST',
+                    album_contents.API_URL + '/albums/{}:batchAddMediaItems'.format(album_id), 'batch_add',
+                    data=add_body, headers={"Content-type": "application/json"})
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            metrics.observe('batch_add', time.monotonic() - started, error=True)
+            return {'error': '{}'.format(e)}
+
+    async def create_album(self, album_title):
+        return await self.request_json('POST', album_contents.API_URL + '/albums',
+                data=json.dumps({"album":{"title": album_title}}),
+                headers={"Content-type": "application/json"})
+
+    async def album_contents(self, album):
+        '''
+        async generator of the album's media items, a page at a time.
+        The next page is requested before this one is read, as album_contents.prefetch_pages does
+        '''
+
+        async def fetch_page(page_token):
+            data_dict = {
+                'albumId':album['id'],
+                'pageSize':album_contents.SEARCH_PAGE_SIZE,
+            }
+            if page_token:
+                data_dict['pageToken'] = page_token
+            resp = await self.request_json('POST', album_contents.API_URL + '/mediaItems:search', 'album_list',
+                    params={'fields': album_contents.SEARCH_FIELDS},
+                    data=json.dumps(data_dict), headers={"Content-type": "application/json"})
+            if 'mediaItems' not in resp:
+                return [], None
+            return resp['mediaItems'], resp.get('nextPageToken')
+
+        page = asyncio.ensure_future(fetch_page(None))
+        try:
+            while page is not None:
+                items, page_token = await page
+                page = asyncio.ensure_future(fetch_page(page_token)) if page_token else None
+                # let the request go out before the page is read
+                await asyncio.sleep(0)
+                for mi in items:
+                    yield mi
+        finally:
+            if page is not None:
+                page.cancel()
+
+    async def upload(self, photo_file_name):
+        '''
+        Upload the whole file in a single request, streamed by aiohttp.
+        Returns the upload token, or None
+        '''
+
+        upload_headers = {
+            "Content-type": "application/octet-stream",
+            "X-Goog-Upload-Protocol": "raw",
+            "X-Goog-Upload-File-Name": photo_file_name.name,
+        }
+        try:
+            # opened for each attempt, aiohttp closes the file once sent
+            status, body, _ = await self.request('POST', album_contents.API_URL + '/uploads',
+                    data=lambda: open(photo_file_name, 'rb'), headers=upload_headers)
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            logging.error("Could not upload file {}: {}".format(photo_file_name, e))
+            return None
+
+        if status == 200 and body:
+            return body.decode()
+
+        logging.error("Could not upload \'{0}\'. Server Response - {1} {2}".format(photo_file_name.name, status, body))
+        return None
+
+    async def upload_resumable(self, photo_file_name, chunk_size, attempts=None):
+        '''
+        Same as upload.upload_resumable: upload the file in chunks, and after a failed chunk
+        ask the server how much it has received and continue from there.
+        Returns the upload token, or None
+        '''
+
+        # the upload method hides the upload module in the class body, not in here
+        attempts = attempts or upload.RESUMABLE_ATTEMPTS
+
+        file_size = os.path.getsize(photo_file_name)
+        mime, encoding = mimetypes.guess_type(photo_file_name.name)
+        start_headers = {
+            "Content-Length": "0",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-File-Name": photo_file_name.name,
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Raw-Size": str(file_size),
+        }
+        if mime:
+            start_headers["X-Goog-Upload-Content-Type"] = mime
+
+        try:
+            status, body, headers = await self.request('POST', album_contents.API_URL + '/uploads',
+                    headers=start_headers)
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            logging.error("Could not start resumable upload of {}: {}".format(photo_file_name, e))
+            return None
+
+        upload_url = headers.get("X-Goog-Upload-URL")
+        if status != 200 or not upload_url:
+            logging.error("Could not start resumable upload of \'{0}\'. Server Response - {1} {2}".format(photo_file_name.name, status, body))
+            return None
+
+        # chunks, except the last one, must be a multiple of the granularity
+        granularity = int(headers.get("X-Goog-Upload-Chunk-Granularity", 0) or 0)
+        if granularity:
+            chunk_size = max(granularity, chunk_size - chunk_size % granularity)
+
+        loop = asyncio.get_running_loop()
+        offset = 0
+        failures = 0
+        with open(photo_file_name, 'rb') as f:
+            while True:
+                f.seek(offset)
+                chunk = await loop.run_in_executor(None, f.read, chunk_size)
+                last = offset + len(chunk) >= file_size
+                chunk_headers = {
+                    "X-Goog-Upload-Command": "upload, finalize" if last else "upload",
+                    "X-Goog-Upload-Offset": str(offset),
+                }
+                try:
+                    status, body, headers = await self.request('POST', upload_url, data=chunk, headers=chunk_headers)
+                    if status == 200:
+                        if last:
+                            if body:
+                                return body.decode()
+                            logging.error("Could not upload \'{0}\', no upload token. Server Response - {1}".format(photo_file_name.name, status))
+                            return None
+                        offset += len(chunk)
+                        continue
+                    logging.info('| Resumable upload of {} at offset {} failed: {} {}'.format(photo_file_name.name, offset, status, body))
+                except QuotaExceeded:
+                    raise
+                except Exception as e:
+                    logging.info('| Resumable upload of {} at offset {} failed: {}'.format(photo_file_name.name, offset, e))
+
+                failures += 1
+                if failures >= attempts:
+                    logging.error("Could not upload \'{0}\' after {1} attempts".format(photo_file_name.name, attempts))
+                    return None
+
+                # Ask the server what it has committed, and continue from there
+                await asyncio.sleep(failures)
+                try:
+                    status, body, headers = await self.request('POST', upload_url, headers={
+                        "Content-Length": "0",
+                        "X-Goog-Upload-Command": "query"})
+                    if headers.get("X-Goog-Upload-Status") != "active":
+                        logging.error("Could not resume upload of \'{0}\'. Server Response - {1} {2}".format(photo_file_name.name, status, body))
+                        return None
+                    offset = int(headers.get("X-Goog-Upload-Size-Received", offset))
+                    logging.info('| Resuming upload of {} at offset {} of {}'.format(photo_file_name.name, offset, file_size))
+                except QuotaExceeded:
+                    raise
+                except Exception as e:
+                    logging.info('| Could not query upload of {}: {}'.format(photo_file_name.name, e))
+
+    async def batch_create(self, create_body):
+        started = time.monotonic()
+        try:
+            return await self.request_json('POST', album_contents.API_URL + '/mediaItems:batchCreate', 'batch_create',
+                    data=create_body, headers={"Content-type": "application/json"})
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            metrics.observe('batch_create', time.monotonic() - started, error=True)
+            return {'error': '{}'.format(e)}
+
+async def upload_photos_async(credentials, photo_file_list, args, catalog=None, ledger=None,
+        album_cache=None, meta_cache=None, manifest=None, journal=None, scheduler=None, library=None):
+    '''
+    Same as upload.upload_photos, on asyncio.
+    Returns Counter of files as upload.upload_photos
+    '''
+
+    counts = Counter()
+    loop = asyncio.get_running_loop()
+    # the ledger fingerprints each file added, reading it, so results are recorded on their own thread
+    recorder = ThreadPoolExecutor(max_workers=1)
+
+    async with AsyncPhotosClient(credentials, args.concurrency, scheduler) as client:
+        app_albums, all_albums = await asyncio.gather(client.albums(True), client.albums(False))
+        if catalog is not None:
+            catalog.set_albums(app_albums, True)
+            catalog.set_albums(all_albums, False)
+
+        targets = upload.AlbumTargets()
+
+        async def open_album(album_title):
+            ''' Same as upload.open_album '''
+
+            album = None
+            created = False
+            for a in app_albums:
+                if a['title'].lower() == album_title.lower():
+                    album = a
+                    logging.info("| Uploading into EXISTING photo album -- \'{0}\'".format(album_title))
+                    break
+
+            if album is None:
+                album = await client.create_album(album_title)
+                logging.debug("Server response: {}".format(album))
+                if "id" not in album:
+                    logging.error("Could not find or create photo album \'{0}\'. Server Response: {1}".format(album_title, album))
+                    return None
+                logging.info("| Uploading into NEW photo album -- \'{0}\'".format(album_title))
+                app_albums.append(album)
+                if catalog is not None:
+                    catalog.add(album)
+                created = True
+
+            album_content_generator = None
+            if created:
+                album_content_generator = ()
+            elif album_cache and not args.refresh_cache:
+                snapshot_album, album_content_generator = album_cache.load(album_title, album_cache.ttl)
+                if snapshot_album and snapshot_album['id'] != album['id']:
+                    album_content_generator = None
+            if album_content_generator is not None:
+                album_content_details = album_contents.MediaIndex(
+                        album_contents.parse_media_items(album_content_generator))
+            else:
+                # indexed as the pages come, without keeping them
+                album_content_details = album_contents.MediaIndex()
+                writer = album_cache.writer(album) if album_cache else None
+                try:
+                    async for mi in client.album_contents(album):
+                        if writer:
+                            writer.add(mi)
+                        media = album_contents.parse_media_item(mi)
+                        if media is not None:
+                            album_content_details.add(media)
+                except BaseException:
+                    if writer:
+                        writer.abort()
+                    raise
+                if writer:
+                    writer.close()
+
+            batch_creator = media_items.BatchCreator(None, album['id'],
+                    max_items=args.batch_size, max_wait=args.batch_wait)
+            return upload.AlbumTarget(album_title, album['id'], album_content_details, batch_creator)
+
+        # interrupt upload if an upload was requested but could not be created
+        if not args.album_template:
+            targets[args.album_name] = await open_album(args.album_name)
+            if targets[args.album_name] is None:
+                return counts
+
+        if journal and args.resume:
+            # Same as upload.resume_uploads
+            for photo_file_name, album_title, upload_token in journal.pending():
+                if album_title not in targets:
+                    targets[album_title] = await open_album(album_title)
+                target = targets[album_title]
+                if target is None:
+                    continue
+                target.batch_creator.add(photo_file_name, upload_token)
+                if manifest:
+                    manifest.compared(photo_file_name, 'resumed', None, album=target.title)
+                counts['resumed'] += 1
+            if counts['resumed']:
+                logging.info('| Journal | adding {} file(s) uploaded by the interrupted run'.format(counts['resumed']))
+
+        uploads = set()
+        creates = set()
+        quota_exceeded = []
+
+        async def create(target, batch):
+            started = time.monotonic()
+            try:
+                resp = await client.batch_create(target.batch_creator.create_body(batch))
+            except QuotaExceeded as e:
+                quota_exceeded.append(e)
+                logging.error('Stopping, {}. {} uploaded file(s) not added to the album'.format(e, len(batch)))
+                return
+            batch_results = target.batch_creator.results(batch, resp, time.monotonic() - started)
+            await created(target, batch_results)
+
+        async def add_existing(target, batch):
+            ''' Same as media_items.BatchCreator.add_to_album '''
+            started = time.monotonic()
+            try:
+                resp = await client.batch_add(target.album_id, target.batch_creator.add_body(batch))
+            except QuotaExceeded as e:
+                quota_exceeded.append(e)
+                logging.error('Stopping, {}. {} file(s) of the library not added to the album'.format(e, len(batch)))
+                return
+            batch_results = target.batch_creator.add_results(batch, resp, time.monotonic() - started)
+            if batch_results is None:
+                for one in batch:
+                    await add_existing(target, [one])
+                return
+            await created(target, batch_results)
+
+        async def created(target, batch_results):
+            target.created(batch_results)
+            number_added = await loop.run_in_executor(recorder, functools.partial(upload.media_items_created,
+                    batch_results, args, ledger, album_cache, manifest, target.title, journal, library))
+            target.added += number_added
+            counts['added'] += number_added
+
+        def flush(target):
+            batches = [create(target, batch) for batch in target.batch_creator.take()]
+            batches += [add_existing(target, batch) for batch in target.batch_creator.take_existing()]
+            for batch in batches:
+                task = asyncio.create_task(batch)
+                creates.add(task)
+                task.add_done_callback(creates.discard)
+
+        async def upload_one(photo_file_name, target):
+            started = time.monotonic()
+            try:
+                file_size = os.path.getsize(photo_file_name)
+            except OSError:
+                file_size = 0
+            try:
+                if args.resumable_mb and file_size > args.resumable_mb * upload.MB:
+                    upload_token = await client.upload_resumable(photo_file_name, args.chunk_mb * upload.MB)
+                else:
+                    upload_token = await client.upload(photo_file_name)
+            except QuotaExceeded as e:
+                quota_exceeded.append(e)
+                return
+            if not upload_token:
+                file_size = 0
+            metrics.observe('upload', time.monotonic() - started, file_size, not upload_token)
+            if manifest:
+                manifest.uploaded(photo_file_name, time.monotonic() - started, file_size, bool(upload_token))
+            if upload_token:
+                target.batch_creator.add(photo_file_name, upload_token)
+                if journal:
+                    journal.token(photo_file_name, target.title, upload_token)
+                if target.batch_creator.due():
+                    flush(target)
+
+        async def flush_when_due():
+            while True:
+                time_left = targets.time_left()
+                await asyncio.sleep(args.batch_wait if time_left is None else time_left)
+                for target in targets:
+                    if target.batch_creator.due():
+                        flush(target)
+
+        timer = asyncio.create_task(flush_when_due())
+
+        # Discovery, the ledger and probing are blocking, they run on their own thread
+        probed = upload.probe_photos(photo_file_list, args, counts, ledger, meta_cache, manifest, journal)
+        with ThreadPoolExecutor(max_workers=1) as prober:
+            try:
+                while True:
+                    item = await loop.run_in_executor(prober, next, probed, DONE)
+                    if item is DONE:
+                        break
+                    photo_file_name, media_on_disk = item
+                    if quota_exceeded:
+                        logging.error('Stopping, {}'.format(quota_exceeded[0]))
+                        break
+                    if photo_file_name is None:
+                        # --watch is waiting for files, uploads and batches go on meanwhile
+                        continue
+
+                    album_title = upload.album_for(args, photo_file_name)
+                    if album_title not in targets:
+                        targets[album_title] = await open_album(album_title)
+                    target = targets[album_title]
+                    if target is None:
+                        # could not find or create the album, already logged
+                        if manifest:
+                            manifest.failed(photo_file_name, 'album_error',
+                                    'could not find or create album', album=album_title)
+                        continue
+
+                    if not args.skip_compare:
+                        # probes the file if it was not, off the event loop
+                        if await loop.run_in_executor(prober, upload.compare_photo, args, photo_file_name,
+                                target.contents, media_on_disk, manifest, target.title) == 'passed':
+                            counts['passed'] += 1
+                            continue
+
+                    if library:
+                        media_item = upload.library_match(args, photo_file_name, library, media_on_disk)
+                        if media_item:
+                            if manifest:
+                                manifest.compared(photo_file_name, 'library', False, album=target.title)
+                            target.batch_creator.add_existing(photo_file_name, media_item)
+                            counts['library'] += 1
+                            if target.batch_creator.due():
+                                flush(target)
+                            continue
+
+                    while len(uploads) >= args.concurrency * upload.UPLOAD_AHEAD:
+                        await asyncio.wait(uploads, return_when=asyncio.FIRST_COMPLETED)
+
+                    task = asyncio.create_task(upload_one(photo_file_name, target))
+                    uploads.add(task)
+                    task.add_done_callback(uploads.discard)
+            except asyncio.CancelledError:
+                # Ctrl-C, asyncio.run cancels this task.  Under --watch, as upload.upload_photos,
+                # the uploads running are still added, only the files not yet started are dropped
+                if not args.watch:
+                    raise
+                uncancel = getattr(asyncio.current_task(), 'uncancel', None)
+                if uncancel:
+                    uncancel()
+                logging.info('| Watch   | stopped, adding the {} file(s) being uploaded'.format(len(uploads)))
+
+        if uploads:
+            await asyncio.wait(uploads)
+        timer.cancel()
+        for target in targets:
+            flush(target)
+        if creates:
+            await asyncio.wait(creates)
+        recorder.shutdown()
+
+    if catalog is not None:
+        for target in targets:
+            catalog.count_added(target.album_id, target.added)
+
+    return counts
+
+def upload_photos(session, photo_file_list, args, catalog=None, ledger=None,
+        album_cache=None, meta_cache=None, manifest=None, journal=None, library=None):
+    ''' Entry point from upload.main, with the credentials of the synchronous session '''
+
+    if aiohttp is None:
+        raise SystemExit('--backend async needs aiohttp: pip install aiohttp')
+
+    return asyncio.run(upload_photos_async(session.credentials, photo_file_list, args,
+            catalog, ledger, album_cache, meta_cache, manifest, journal, getattr(session, 'scheduler', None),
+            library))
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import time
+
+class AlbumCache:
+    '''
+    Snapshot of each album's contents on disk, as JSON lines: a header with
+    the album and the time it was fetched, then one line per media item.
+    Items added by this tool are appended as they are created, so the snapshot
+    only needs a full refresh when asked, or when older than ttl hours.
+    '''
+
+    def __init__(self, cache_dir, ttl_hours=24):
+        self.cache_dir = Path(cache_dir) / 'albums'
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl_hours * 3600
+
+    def path(self, album_title):
+        name = hashlib.sha1(album_title.lower().encode()).hexdigest()
+        return self.cache_dir / '{}.jsonl'.format(name)
+
+    def load(self, album_title, max_age=None):
+        '''
+        returns (album, generator of media items), or (None, None) if there is
+        no snapshot, or it is older than max_age seconds
+        '''
+
+        path = self.path(album_title)
+        try:
+            with open(path) as f:
+                header = json.loads(f.readline())
+        except (OSError, ValueError) as e:
+            logging.debug('No album snapshot for {}: {}'.format(album_title, e))
+            return None, None
+
+        age = time.time() - header['fetched']
+        if max_age is not None and age > max_age:
+            logging.debug('Album snapshot for {} is {:.0f} seconds old, refreshing'.format(album_title, age))
+            return None, None
+
+        logging.info('| Using album snapshot of \'{}\', {:.1f} hours old'.format(album_title, age / 3600))
+
+        def items():
+            with open(path) as f:
+                f.readline()
+                for line in f:
+                    yield json.loads(line)
+
+        return header['album'], items()
+
+    def record(self, album, media_items):
+        ''' Pass media items through, writing them to a new snapshot, see SnapshotWriter '''
+
+        writer = SnapshotWriter(self.path(album['title']), album)
+        try:
+            for mi in media_items:
+                writer.add(mi)
+                yield mi
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+
+    def writer(self, album):
+        ''' for media items that do not come as a generator, e.g. pages fetched by asyncio '''
+        return SnapshotWriter(self.path(album['title']), album)
+
+    def append(self, album_title, media_item):
+        path = self.path(album_title)
+        if not path.exists():
+            return
+
+        with open(path, 'a') as f:
+            print(json.dumps(lean_media_item(media_item)), file=f)
+
+class SnapshotWriter:
+    '''
+    A new snapshot of an album, written to a temporary file as items are added.
+    On close, it replaces the snapshot only if the number of items matches
+    the album's mediaItemsCount, a short listing is not mistaken for the album's contents.
+    '''
+
+    def __init__(self, path, album):
+        self.path = path
+        self.album = album
+        self.tmp = path.with_suffix('.tmp')
+        self.count = 0
+        self.f = open(self.tmp, 'w')
+        print(json.dumps({'album': album, 'fetched': time.time()}), file=self.f)
+
+    def add(self, media_item):
+        print(json.dumps(lean_media_item(media_item)), file=self.f)
+        self.count += 1
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+    def close(self):
+        self.f.close()
+        if self.count == int(self.album.get('mediaItemsCount', 0)):
+            os.replace(self.tmp, self.path)
+        else:
+            logging.debug('Album {} listed {} of {} items, not saving snapshot'.format(
+                self.album['title'], self.count, self.album.get('mediaItemsCount', 0)))
+            os.remove(self.tmp)
+
+def lean_media_item(mi):
+    ''' only the fields compare_media needs '''
+
+    lean = {'id': mi.get('id'), 'filename': mi.get('filename'), 'mimeType': mi.get('mimeType')}
+    if 'mediaMetadata' in mi:
+        lean['mediaMetadata'] = {'creationTime': mi['mediaMetadata'].get('creationTime', '')}
+    return lean
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -1,82 +1,340 @@
+from datetime import datetime, timedelta, timezone
 import json
 import logging
+import os
+import queue
+import threading
 
-import arrow
+from utils import metrics
+
+# GPHOTOS_API_URL points the tool at a stand-in server, see benchmarks/
+API_URL = os.environ.get('GPHOTOS_API_URL', 'https://photoslibrary.googleapis.com/v1')
+
+# The largest pages the API allows
+ALBUMS_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 100
+
+# Pages fetched ahead of the one being read, a bound on the memory they take
+PREFETCH_PAGES = 2
+
+# Partial responses, only the fields read here, AlbumCatalog and lean_media_item.
+# Most of a media item is baseUrl, productUrl and the camera metadata, none of them used
+# https://developers.google.com/photos/library/guides/performance-tips
+ALBUM_FIELDS = 'albums(id,title,mediaItemsCount,isWriteable),nextPageToken'
+SEARCH_FIELDS = 'mediaItems(id,filename,mimeType,mediaMetadata/creationTime),nextPageToken'
+
+def response_bytes(resp):
+    ''' bytes on the wire, compressed if the response was, where the server says '''
+    try:
+        return int(resp.headers['Content-Length'])
+    except (KeyError, ValueError):
+        return len(resp.content)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+def parse_creation_time(text):
+    '''
+    mediaMetadata.creationTime, RFC 3339 such as 2020-01-15T10:00:00Z,
+    as integer microseconds since the epoch.  None if it can not be parsed
+    '''
+
+    if not text:
+        return None
+    try:
+        d = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        # more digits of fractional seconds than fromisoformat takes, before Python 3.11
+        try:
+            import arrow
+            d = arrow.get(text).datetime
+        except Exception as e:
+            logging.debug('Could not parse creation time {}: {}'.format(text, e))
+            return None
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return (d - EPOCH) // MICROSECOND
 
 class Media:
-    ''' Media on Google Cloud'''
+    '''
+    Media on Google Cloud.  Slotted, with the creation time as integer microseconds,
+    as albums can have hundreds of thousands of items
+    '''
+
+    __slots__ = ('filename', 'mimetype', 'creation_us')
 
-    def __init__(self, mimetype, filename):
+    def __init__(self, mimetype, filename, creation_us=None):
         self.filename = filename
         self.mimetype = mimetype
-        self.media_metadata_creation_time = ''
+        self.creation_us = creation_us
 
     def __repr__(self):
         return '{}'.format(self.filename)
 
+    @property
+    def media_metadata_creation_time(self):
+        if self.creation_us is None:
+            return ''
+        return (EPOCH + self.creation_us * MICROSECOND).isoformat().replace('+00:00', 'Z')
+
+    @media_metadata_creation_time.setter
+    def media_metadata_creation_time(self, text):
+        self.creation_us = parse_creation_time(text)
+
     @property
     def creation_ts(self):
-        ''' reformatting, removing Z, etc '''
-        d = arrow.get(self.media_metadata_creation_time)
-        return d.datetime
+        ''' aware datetime, in UTC.  Raises ValueError without a creation time '''
+        if self.creation_us is None:
+            raise ValueError('{} has no creation time'.format(self.filename))
+        return EPOCH + self.creation_us * MICROSECOND
 
-def get_album_contents(session, album):
-    ''' returns generator '''
+class MediaIndex:
+    '''
+    Album contents keyed by filename, then mimetype, so a file on disk
+    can be looked up without scanning the whole album.
+    Each item is packed into a single int: its creation time in microseconds,
+    shifted left of a number for its mimetype.  The filename is only kept
+    as the key, the raw JSON and Media objects are not kept at all.
+    lookup and iterating return Media built on the fly.
+    '''
 
-    session.headers["Content-type"] = "application/json"
-    data_dict = {
-        'albumId':album['id'],
-        'pageSize':'100',
-    }
-    while True:
-        data = json.dumps(data_dict, indent=4)
-        resp = session.post('https://photoslibrary.googleapis.com/v1/mediaItems:search', data).json()
-        if 'mediaItems' in resp: 
-            for mi in resp['mediaItems']: 
-                yield mi
-
-            if 'nextPageToken' in resp:
-                data_dict['pageToken'] = resp['nextPageToken']
-            else:
-                return
+    MIME_BITS = 16
+    # packed for items without a creation time, which never match
+    NO_TIME = -1 << 62
+
+    def __init__(self, media_items=()):
+        self.by_name = {}
+        self.mimetypes = []
+        self.mime_ids = {}
+        self.count = 0
+        for media in media_items:
+            self.add(media)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for filename, packed in self.by_name.items():
+            for p in (packed if isinstance(packed, list) else (packed,)):
+                yield self.unpack(filename, p)
+
+    def mime_id(self, mimetype):
+        mime_id = self.mime_ids.get(mimetype)
+        if mime_id is None:
+            mime_id = self.mime_ids[mimetype] = len(self.mimetypes)
+            self.mimetypes.append(mimetype)
+        return mime_id
+
+    def unpack(self, filename, packed):
+        creation_us = packed >> self.MIME_BITS
+        return Media(self.mimetypes[packed & ((1 << self.MIME_BITS) - 1)], filename,
+                None if creation_us == self.NO_TIME else creation_us)
+
+    def add(self, media):
+        if media.creation_us is None:
+            logging.debug('No creation time for {}'.format(media))
+        creation_us = self.NO_TIME if media.creation_us is None else media.creation_us
+        packed = creation_us << self.MIME_BITS | self.mime_id(media.mimetype)
+
+        # one item per filename is the rule, a list only for the exceptions
+        existing = self.by_name.get(media.filename)
+        if existing is None:
+            self.by_name[media.filename] = packed
+        elif isinstance(existing, list):
+            existing.append(packed)
         else:
-            return
+            self.by_name[media.filename] = [existing, packed]
+        self.count += 1
 
-def parse_media_items(album_content_generator):
-    media_items = []
+    def lookup(self, filename, mimetype=None):
+        packed = self.by_name.get(filename)
+        if packed is None:
+            return []
+        items = [self.unpack(filename, p) for p in (packed if isinstance(packed, list) else (packed,))]
+        if mimetype is None:
+            return items
+        return [mi for mi in items if mi.mimetype == mimetype]
 
-    for ea in album_content_generator:
-        media = Media(ea['mimeType'], ea['filename'])
-        if 'mediaMetadata' in ea.keys():
-            media.media_metadata_creation_time = ea['mediaMetadata'].get('creationTime', '')
-            media_items.append(media)
+class AlbumCatalog:
+    '''
+    Albums listed once per session, and kept up to date as albums are created
+    and items added.  Albums created by this app are listed separately,
+    as the API only allows uploading into those.
+    '''
 
-    return media_items
+    def __init__(self, session):
+        self.session = session
+        self._albums = {}
 
+    def albums(self, appCreatedOnly=False):
+        if appCreatedOnly not in self._albums:
+            self._albums[appCreatedOnly] = list(get_albums(self.session, appCreatedOnly))
+        return self._albums[appCreatedOnly]
 
-def get_albums(session, appCreatedOnly=False):
+    def set_albums(self, albums, appCreatedOnly=False):
+        ''' albums listed elsewhere, e.g. by the async backend '''
+        self._albums[appCreatedOnly] = list(albums)
 
-    params = {
-            'excludeNonAppCreatedData': appCreatedOnly
-    }
+    def find(self, album_title, appCreatedOnly=True):
+        for a in self.albums(appCreatedOnly):
+            if a['title'].lower() == album_title.lower():
+                return a
+        return None
 
-    while True:
+    def add(self, album):
+        for albums in self._albums.values():
+            albums.append(album)
 
-        albums = session.get('https://photoslibrary.googleapis.com/v1/albums', params=params).json()
+    def count_added(self, album_id, number_added):
+        # an album created in this run is the same dict in every list
+        counted = set()
+        for albums in self._albums.values():
+            for a in albums:
+                if a['id'] == album_id and id(a) not in counted:
+                    counted.add(id(a))
+                    a['mediaItemsCount'] = str(int(a.get('mediaItemsCount', 0)) + number_added)
 
-        #logging.debug("Server response: {}".format(albums))
+def prefetch_pages(fetch_page, depth=PREFETCH_PAGES):
+    '''
+    Generator of the items of each page, fetch_page(page_token) returning the page's
+    items and the next page token, None for the last page.
+    A thread fetches the next page as soon as the previous one arrives, at most
+    depth pages ahead of the consumer, so listing takes about the time of the requests alone.
+    An exception of fetch_page is raised to the consumer.
+    Closing the generator waits for a request in flight, so the caller can use the
+    session again once it is done with the generator.  Ctrl-C while waiting for a page
+    does not wait, the daemon thread is left to finish its request, retries included
+    '''
 
-        if 'albums' in albums:
+    pages = queue.Queue(maxsize=depth)
+    stop = threading.Event()
 
-            for a in albums["albums"]:
-                yield a
+    def put(page):
+        ''' False once the consumer has gone '''
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-            if 'nextPageToken' in albums:
-                params["pageToken"] = albums["nextPageToken"]
-            else:
+    def fetcher():
+        page_token = None
+        try:
+            while True:
+                items, page_token = fetch_page(page_token)
+                if not put((items, None)) or not page_token:
+                    break
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    thread = threading.Thread(target=fetcher, name='album-pager', daemon=True)
+    thread.start()
+    interrupted = False
+    try:
+        while True:
+            items, error = pages.get()
+            if error is not None:
+                raise error
+            if items is None:
                 return
+            yield from items
+    except KeyboardInterrupt:
+        interrupted = True
+        raise
+    finally:
+        stop.set()
+        if not interrupted:
+            thread.join()
 
-        else:
-            return
+def get_album_contents(session, album):
+    ''' returns generator, the pages fetched ahead by prefetch_pages '''
+
+    session.headers["Content-type"] = "application/json"
+
+    def fetch_page(page_token):
+        data_dict = {
+            'albumId':album['id'],
+            'pageSize':SEARCH_PAGE_SIZE,
+        }
+        if page_token:
+            data_dict['pageToken'] = page_token
+        with metrics.timer('album_list') as t:
+            resp = session.post(API_URL + '/mediaItems:search', json.dumps(data_dict),
+                    params={'fields': SEARCH_FIELDS})
+            t.nbytes = response_bytes(resp)
+            resp = resp.json()
+            t.error = 'error' in resp
+        if 'mediaItems' not in resp:
+            return [], None
+        return resp['mediaItems'], resp.get('nextPageToken')
+
+    yield from prefetch_pages(fetch_page)
+
+def get_library_contents(session):
+    ''' returns generator of the media items of the whole library, most recently taken first, see get_album_contents '''
+
+    def fetch_page(page_token):
+        params = {
+                'pageSize': SEARCH_PAGE_SIZE,
+                'fields': SEARCH_FIELDS,
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        with metrics.timer('album_list') as t:
+            resp = session.get(API_URL + '/mediaItems', params=params)
+            t.nbytes = response_bytes(resp)
+            resp = resp.json()
+            t.error = 'error' in resp
+        if 'mediaItems' not in resp:
+            return [], None
+        return resp['mediaItems'], resp.get('nextPageToken')
+
+    yield from prefetch_pages(fetch_page)
+
+def parse_media_item(ea):
+    ''' Media of a media item resource, None if it has no mediaMetadata '''
+    if 'mediaMetadata' not in ea:
+        return None
+    return Media(ea['mimeType'], ea['filename'],
+            parse_creation_time(ea['mediaMetadata'].get('creationTime', '')))
+
+def parse_media_items(album_content_generator):
+    ''' generator, so an album is indexed as its pages come, without keeping them '''
+
+    for ea in album_content_generator:
+        media = parse_media_item(ea)
+        if media is not None:
+            yield media
+
+
+def get_albums(session, appCreatedOnly=False):
+    ''' returns generator, the pages fetched ahead by prefetch_pages '''
+
+    def fetch_page(page_token):
+        params = {
+                'excludeNonAppCreatedData': appCreatedOnly,
+                'pageSize': ALBUMS_PAGE_SIZE,
+                'fields': ALBUM_FIELDS,
+        }
+        if page_token:
+            params["pageToken"] = page_token
+
+        with metrics.timer('album_list') as t:
+            albums = session.get(API_URL + '/albums', params=params)
+            t.nbytes = response_bytes(albums)
+            albums = albums.json()
+            t.error = 'error' in albums
+
+        #logging.debug("Server response: {}".format(albums))
+
+        if 'albums' not in albums:
+            return [], None
+        return albums["albums"], albums.get('nextPageToken')
+
+    yield from prefetch_pages(fetch_page)
   
 # vim: ai et ts=4 sw=4 sts=4 nu
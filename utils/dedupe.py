@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import os
+
+from utils.upload_ledger import FINGERPRINT_BLOCK, fingerprint
+
+HASH_BLOCK = 1024 * 1024
+
+def full_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK)
+            if not block:
+                return h.hexdigest()
+            h.update(block)
+
+class DuplicateFinder:
+    '''
+    Finds files with the same content as a file seen earlier in the run.
+    Files are compared by size first, then by a partial hash (the ledger's fingerprint:
+    size, first and last 64KB), and only then by a hash of the whole file.
+    Most files have a size no other file has, and are never read.
+    '''
+
+    def __init__(self):
+        self.by_size = {}
+        self.sizes = {}
+        self.partial = {}
+        self.full = {}
+        self.hashed_bytes = 0
+
+    def partial_hash(self, path, size):
+        if path not in self.partial:
+            self.partial[path] = fingerprint(path, size)
+            self.hashed_bytes += min(size, 2 * FINGERPRINT_BLOCK)
+        return self.partial[path]
+
+    def full_hash(self, path, size):
+        # the partial hash already covers small files
+        if size <= 2 * FINGERPRINT_BLOCK:
+            return self.partial_hash(path, size)
+        if path not in self.full:
+            self.full[path] = full_hash(path)
+            self.hashed_bytes += size
+        return self.full[path]
+
+    def forget(self, path):
+        ''' a file seen again, e.g. changed under upload.py --watch, is hashed afresh '''
+
+        size = self.sizes.pop(path, None)
+        if size is None:
+            return
+        self.by_size[size].remove(path)
+        self.partial.pop(path, None)
+        self.full.pop(path, None)
+
+    def duplicate_of(self, path):
+        '''
+        The earlier file with the same content, or None if path is the first seen.
+        Files that can not be read are never duplicates
+        '''
+
+        self.forget(path)
+        try:
+            size = os.path.getsize(path)
+            earlier = self.by_size.setdefault(size, [])
+            if earlier:
+                partial = self.partial_hash(path, size)
+                for other in earlier:
+                    if self.partial_hash(other, size) == partial and \
+                            self.full_hash(other, size) == self.full_hash(path, size):
+                        return other
+            earlier.append(path)
+            self.sizes[path] = size
+        except OSError as e:
+            logging.debug('Could not check {} for duplicates: {}'.format(path, e))
+
+        return None
+
+# vim: ai et ts=4 sw=4 sts=4 nu
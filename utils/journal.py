@@ -0,0 +1,144 @@
+import logging
+import os
+from pathlib import Path
+import time
+
+from utils.sqlite_store import SQLiteStore
+
+# upload tokens are valid for a day, keep a margin
+TOKEN_SECONDS = 23 * 60 * 60
+
+class RunJournal(SQLiteStore):
+    '''
+    SQLite journal of a run, written as it goes, so an interrupted run can be resumed.
+    Each upload token is recorded as soon as /v1/uploads returns it, and each
+    mediaItems:batchCreate result as soon as it comes back, as are the files
+    added from the library with albums:batchAddMediaItems.
+    With resume, the files uploaded but not added are added with their recorded
+    token, without sending their bytes again, and the files already added are passed.
+    Without, the journal of the previous run is cleared.
+    Files changed since they were journaled are uploaded again.
+    '''
+
+    def __init__(self, path, resume=False):
+        # a commit per upload token, WAL keeps that cheap
+        super().__init__(path, ['''CREATE TABLE IF NOT EXISTS uploads (
+                path TEXT NOT NULL,
+                album TEXT NOT NULL COLLATE NOCASE,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                upload_token TEXT,
+                uploaded REAL,
+                media_item_id TEXT,
+                created REAL,
+                error TEXT,
+                PRIMARY KEY (path, album))'''],
+                pragmas=['journal_mode=WAL', 'synchronous=NORMAL'])
+        if not resume:
+            self.execute('DELETE FROM uploads')
+            self.commit()
+        self.resumed = set()
+
+    @staticmethod
+    def key(photo_file_name, album_title):
+        return os.path.abspath(photo_file_name), album_title.lower()
+
+    @staticmethod
+    def unchanged(path, size, mtime_ns):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == (size, mtime_ns)
+
+    def pending(self):
+        '''
+        Files uploaded by the interrupted run but not added to their album,
+        as a list of (photo_file_name, album_title, upload_token).
+        Expired tokens, and tokens of files changed since, are left out
+        '''
+
+        rows = self.fetchall('''SELECT path, album, size, mtime_ns, upload_token, uploaded
+                FROM uploads WHERE upload_token IS NOT NULL AND created IS NULL''')
+
+        pending = []
+        for path, album, size, mtime_ns, upload_token, uploaded in rows:
+            if time.time() - uploaded > TOKEN_SECONDS:
+                logging.info('| Journal | upload token of {} expired, uploading again'.format(path))
+                continue
+            if not self.unchanged(path, size, mtime_ns):
+                logging.info('| Journal | {} changed since it was uploaded, uploading again'.format(path))
+                continue
+            pending.append((Path(path), album, upload_token))
+            self.resumed.add(self.key(path, album))
+
+        return pending
+
+    def skip(self, photo_file_name, album_title):
+        '''
+        'resumed' if the file's upload token is being added from the journal,
+        'added' if it was added, unchanged since, else None
+        '''
+
+        key = self.key(photo_file_name, album_title)
+        if key in self.resumed:
+            return 'resumed'
+
+        row = self.fetchone('''SELECT size, mtime_ns FROM uploads
+                WHERE path=? AND album=? AND created IS NOT NULL''', key)
+        if row and self.unchanged(key[0], *row):
+            return 'added'
+        return None
+
+    def token(self, photo_file_name, album_title, upload_token):
+        try:
+            stat = os.stat(photo_file_name)
+        except OSError as e:
+            logging.info('| Journal | could not record {}: {}'.format(photo_file_name, e))
+            return
+
+        path = os.path.abspath(photo_file_name)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, NULL)',
+                    (path, album_title, stat.st_size, stat.st_mtime_ns, upload_token, time.time()))
+            self.conn.commit()
+
+    def created(self, photo_file_name, album_title, status, media_item):
+        '''
+        status and media_item from mediaItems:batchCreate.  If the whole call failed,
+        status None, the token is kept to be tried again on resume.
+        A token refused by batchCreate is dropped, the file is uploaded again.
+        A file added from the library, status marked 'library', has no token: it is
+        recorded once added, and looked up in the library again if it was not
+        '''
+
+        if status is None:
+            return
+
+        if status.get('library'):
+            if not (status.get('code') or 0) > 0:
+                self.library_added(photo_file_name, album_title, media_item)
+            return
+
+        path, album = self.key(photo_file_name, album_title)
+        code = status.get('code') or 0
+        if code > 0:
+            self.execute('''UPDATE uploads SET upload_token=NULL, error=?
+                    WHERE path=? AND album=?''', (status.get('message'), path, album))
+        else:
+            self.execute('''UPDATE uploads SET media_item_id=?, created=?, error=NULL
+                    WHERE path=? AND album=?''', ((media_item or {}).get('id'), time.time(), path, album))
+
+    def library_added(self, photo_file_name, album_title, media_item):
+        try:
+            stat = os.stat(photo_file_name)
+        except OSError as e:
+            logging.info('| Journal | could not record {}: {}'.format(photo_file_name, e))
+            return
+
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, NULL, ?, ?, ?, NULL)',
+                (os.path.abspath(photo_file_name), album_title, stat.st_size, stat.st_mtime_ns, now,
+                 (media_item or {}).get('id'), now))
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,121 @@
+import logging
+import time
+
+from utils import album_contents
+from utils.sqlite_store import SQLiteStore
+
+class LibraryIndex(SQLiteStore):
+    '''
+    SQLite index of the media items of the whole library, from mediaItems:list,
+    by filename and creation time.  A file already uploaded, into another album
+    or none, is then added to its album with albums:batchAddMediaItems instead
+    of being uploaded again.
+    The library is listed in full the first time, and again once that listing is older
+    than the ttl.  In between, refreshes are quick: mediaItems:list returns items
+    by the date they were taken, most recent first, so listing stops after a page of
+    items all indexed already.  That finds new photos taken recently, but not a file
+    uploaded today that was taken years ago, by another run without the index;
+    the next full listing does.  Items created by runs with the index are indexed as they are.
+    The API only lists, and only adds to albums, media items created by this app.
+    '''
+
+    def __init__(self, path):
+        super().__init__(path, [
+                '''CREATE TABLE IF NOT EXISTS media (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    mime_type TEXT,
+                    creation_us INTEGER)''',
+                'CREATE INDEX IF NOT EXISTS media_name_time ON media (filename, creation_us)',
+                '''CREATE TABLE IF NOT EXISTS state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT)'''])
+
+    def count(self):
+        return self.fetchone('SELECT COUNT(*) FROM media')[0]
+
+    def listed(self):
+        ''' when the whole library was last listed, None if it never was '''
+        row = self.fetchone("SELECT value FROM state WHERE key='listed'")
+        return float(row[0]) if row else None
+
+    def add(self, media_item):
+        ''' Index a media item resource.  Returns True if it was not indexed already '''
+
+        media = album_contents.parse_media_item(media_item)
+        if media is None or 'id' not in media_item:
+            return False
+        cursor = self.execute('INSERT OR IGNORE INTO media VALUES (?, ?, ?, ?)',
+                (media_item['id'], media.filename, media.mimetype, media.creation_us))
+        return cursor.rowcount > 0
+
+    def forget(self, media_item_id):
+        ''' e.g. deleted from the library since it was indexed '''
+        self.execute('DELETE FROM media WHERE id=?', (media_item_id,))
+
+    def refresh(self, session, full=False, ttl=None):
+        '''
+        List the library, the whole of it with full, if it never was,
+        or if it was more than ttl seconds ago.
+        A full listing replaces the index, once it completes.
+        Returns the number of media items indexed that were not before
+        '''
+
+        listed = self.listed()
+        full = full or listed is None or (ttl is not None and time.time() - listed > ttl)
+        logging.info('| Library | listing the {} library'.format('whole' if full else 'most recent of the'))
+
+        if full:
+            self.execute('DELETE FROM media')
+
+        new = 0
+        known = 0
+        media_items = album_contents.get_library_contents(session)
+        try:
+            for mi in media_items:
+                if self.add(mi):
+                    new += 1
+                    known = 0
+                    continue
+                known += 1
+                if not full and known >= album_contents.SEARCH_PAGE_SIZE:
+                    break
+            with self.lock:
+                if full:
+                    self.conn.execute("INSERT OR REPLACE INTO state VALUES ('listed', ?)", (str(time.time()),))
+                self.conn.commit()
+        except BaseException:
+            # a full listing cut short keeps the previous index
+            with self.lock:
+                self.conn.rollback()
+            raise
+        finally:
+            media_items.close()
+
+        logging.info('| Library | {} new media item(s), {} indexed'.format(new, self.count()))
+        return new
+
+    def find(self, filename, mimetype, creation_times):
+        '''
+        A media item, with only id, filename, mimeType and creationTime, of the given
+        filename and mimetype, created at one of creation_times (aware datetimes).
+        None if there is none
+        '''
+
+        creation_us = [(ts - album_contents.EPOCH) // album_contents.MICROSECOND
+                for ts in creation_times if ts]
+        if not creation_us:
+            return None
+
+        row = self.fetchone('''SELECT id, creation_us FROM media
+                WHERE filename=? AND creation_us IN ({}) AND mime_type=?'''.format(
+                ', '.join('?' * len(creation_us))),
+                [filename] + creation_us + [mimetype])
+        if row is None:
+            return None
+
+        media = album_contents.Media(mimetype, filename, row[1])
+        return {'id': row[0], 'filename': filename, 'mimeType': mimetype,
+                'mediaMetadata': {'creationTime': media.media_metadata_creation_time}}
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,80 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+# every record has all of these, in this order
+FIELDS = ('path', 'size', 'album', 'decision', 'reason', 'in_album', 'upload_seconds', 'create_seconds',
+        'bytes_sent', 'media_item_id', 'duplicate_of', 'error', 'time')
+
+class RunManifest:
+    '''
+    Outcome of each file, as JSON lines written as the run goes, so retry lists
+    and reports can be built without parsing the log.  One record per file, see FIELDS.
+    decision is pass, added, upload (--test-stat-times only), or an error:
+    read_error, album_error, upload_failed, create_failed, not_added (the run stopped first).
+    reason is the comparison's, see probe_meta.match_media, or ledger, or duplicate,
+    or library (added from the library without uploading, see --library-index).
+    Files being uploaded are held until their mediaItems:batchCreate result.
+    '''
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.f = open(path, 'w', buffering=1)
+        self.pending = {}
+
+    def write(self, photo_file_name, decision, **fields):
+        record = dict.fromkeys(FIELDS)
+        record.update(path=str(photo_file_name), decision=decision)
+        try:
+            record['size'] = os.path.getsize(photo_file_name)
+        except OSError:
+            pass
+        record.update(fields)
+        record['time'] = datetime.now().isoformat(timespec='seconds')
+        with self.lock:
+            self.f.write(json.dumps(record) + '\n')
+
+    def passed(self, photo_file_name, reason, in_album=None, **fields):
+        self.write(photo_file_name, 'pass', reason=reason, in_album=in_album, **fields)
+
+    def compared(self, photo_file_name, reason, in_album, **fields):
+        ''' to be uploaded, the record is written once it is added '''
+        with self.lock:
+            self.pending[photo_file_name] = dict(fields, reason=reason, in_album=in_album)
+
+    def failed(self, photo_file_name, decision, error, **fields):
+        with self.lock:
+            pending = self.pending.pop(photo_file_name, {})
+        pending.update(fields)
+        self.write(photo_file_name, decision, error=error, **pending)
+
+    def uploaded(self, photo_file_name, seconds, bytes_sent, ok=True):
+        fields = {'upload_seconds': round(seconds, 3), 'bytes_sent': bytes_sent}
+        if not ok:
+            return self.failed(photo_file_name, 'upload_failed', 'no upload token', **fields)
+        with self.lock:
+            self.pending.setdefault(photo_file_name, {}).update(fields)
+
+    def created(self, photo_file_name, status, media_item, seconds=None):
+        ''' status and media_item from mediaItems:batchCreate, status None if the call failed '''
+
+        fields = {'create_seconds': None if seconds is None else round(seconds, 3)}
+        if status is None:
+            return self.failed(photo_file_name, 'create_failed', 'mediaItems:batchCreate failed', **fields)
+        if status.get('code') and status.get('code') > 0:
+            return self.failed(photo_file_name, 'create_failed', status.get('message'), **fields)
+
+        with self.lock:
+            pending = self.pending.pop(photo_file_name, {})
+        pending.update(fields)
+        self.write(photo_file_name, 'added', media_item_id=(media_item or {}).get('id'), **pending)
+
+    def close(self):
+        ''' files uploaded but not added, e.g. after a quota ran out '''
+
+        for photo_file_name in list(self.pending):
+            self.failed(photo_file_name, 'not_added', 'run stopped before the file was added')
+        self.f.close()
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,192 @@
+import json
+import logging
+import time
+
+from utils import album_contents, metrics
+from utils.scheduler import QuotaExceeded
+
+BATCH_CREATE_MAX = 50
+
+class BatchCreator:
+    '''
+    Collects upload tokens and turns them into media items with
+    mediaItems:batchCreate, up to 50 items per call.
+    Media items already in the library are collected too, and added to the album
+    with albums:batchAddMediaItems, up to 50 per call.
+    A batch is due when it is full, or when its oldest token or item has waited max_wait seconds.
+    '''
+
+    def __init__(self, session, album_id, max_items=BATCH_CREATE_MAX, max_wait=30):
+        self.session = session
+        self.album_id = album_id
+        self.max_items = min(max_items, BATCH_CREATE_MAX)
+        self.max_wait = max_wait
+        self.pending = []
+        self.existing = []
+        self.oldest = None
+
+    def __len__(self):
+        return len(self.pending) + len(self.existing)
+
+    def add(self, photo_file_name, upload_token):
+        if not self:
+            self.oldest = time.monotonic()
+        self.pending.append((photo_file_name, upload_token))
+
+    def add_existing(self, photo_file_name, media_item):
+        ''' a media item already in the library, for photo_file_name '''
+        if not self:
+            self.oldest = time.monotonic()
+        self.existing.append((photo_file_name, media_item))
+
+    def time_left(self):
+        ''' seconds until the pending batch is due, None if nothing is pending '''
+        if not self:
+            return None
+        return max(0, self.oldest + self.max_wait - time.monotonic())
+
+    def due(self):
+        return bool(self) and (
+                len(self.pending) >= self.max_items or len(self.existing) >= self.max_items
+                or self.time_left() == 0)
+
+    def flush(self, results=None):
+        '''
+        returns list of (photo_file_name, status, media_item, seconds)
+        status is the newMediaItemResults status, or None if the whole call failed,
+        seconds the time taken by the call.
+        results, if given, is the list the results are added to as they come, so after
+        a QuotaExceeded it holds those of the batches sent.  The batches not sent are pending again
+        '''
+
+        if results is None:
+            results = []
+        batches = [(self.create, batch) for batch in self.take()]
+        batches += [(self.add_to_album, batch) for batch in self.take_existing()]
+        for i, (send, batch) in enumerate(batches):
+            try:
+                results.extend(send(batch))
+            except QuotaExceeded:
+                self.put_back(batches[i:])
+                raise
+
+        return results
+
+    def put_back(self, batches):
+        ''' batches taken but not sent, as flush lists them, pending again '''
+
+        if not self:
+            self.oldest = time.monotonic()
+        self.pending[:0] = [item for send, batch in batches if send == self.create for item in batch]
+        self.existing[:0] = [item for send, batch in batches if send == self.add_to_album for item in batch]
+
+    def take(self):
+        ''' remove the upload tokens pending, as a list of batches of at most max_items '''
+
+        batches = []
+        while self.pending:
+            batches.append(self.pending[:self.max_items])
+            self.pending = self.pending[self.max_items:]
+
+        if not self.existing:
+            self.oldest = None
+        return batches
+
+    def take_existing(self):
+        ''' remove the media items pending, as take does the upload tokens '''
+
+        batches = []
+        while self.existing:
+            batches.append(self.existing[:self.max_items])
+            self.existing = self.existing[self.max_items:]
+
+        if not self.pending:
+            self.oldest = None
+        return batches
+
+    def create_body(self, batch):
+        return json.dumps({"albumId":self.album_id, "newMediaItems":[
+            {"description":"","simpleMediaItem":{"uploadToken":upload_token}} for _, upload_token in batch]}, indent=4)
+
+    def create(self, batch):
+        body = self.create_body(batch)
+        with metrics.timer('batch_create', len(body)) as t:
+            try:
+                resp = self.session.post(album_contents.API_URL + '/mediaItems:batchCreate', body,
+                        headers={"Content-type": "application/json"}).json()
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                resp = {'error': '{}'.format(e)}
+            t.error = "newMediaItemResults" not in resp
+
+        return self.results(batch, resp, t.seconds)
+
+    def add_body(self, batch):
+        return json.dumps({"mediaItemIds": [media_item['id'] for _, media_item in batch]})
+
+    def add_url(self):
+        return album_contents.API_URL + '/albums/{}:batchAddMediaItems'.format(self.album_id)
+
+    def add_to_album(self, batch):
+        body = self.add_body(batch)
+        with metrics.timer('batch_add', len(body)) as t:
+            try:
+                resp = self.session.post(self.add_url(), body,
+                        headers={"Content-type": "application/json"}).json()
+            except QuotaExceeded:
+                raise
+            except Exception as e:
+                resp = {'error': '{}'.format(e)}
+            t.error = 'error' in resp
+
+        results = self.add_results(batch, resp, t.seconds)
+        if results is None:
+            # one bad media item fails the whole call, find which
+            results = [r for one in batch for r in self.add_to_album([one])]
+        return results
+
+    def add_results(self, batch, resp, seconds=None):
+        '''
+        map an albums:batchAddMediaItems response back to the files of the batch,
+        as results does, each status marked 'library'.
+        None if the call failed for a batch of several, to be tried one by one
+        '''
+
+        logging.debug("Server response albums:batchAddMediaItems: {}".format(resp))
+
+        if 'error' not in resp:
+            return [(photo_file_name, {'message': 'Success', 'library': True}, media_item, seconds)
+                    for photo_file_name, media_item in batch]
+        if len(batch) > 1:
+            return None
+
+        error = resp['error'] if isinstance(resp['error'], dict) else {'message': resp['error']}
+        photo_file_name, media_item = batch[0]
+        return [(photo_file_name, {'code': error.get('code') or 2, 'message': error.get('message'), 'library': True},
+                media_item, seconds)]
+
+    def results(self, batch, resp, seconds=None):
+        ''' map a mediaItems:batchCreate response back to the files of the batch '''
+
+        logging.debug("Server response mediaItems:batchCreate: {}".format(resp))
+
+        if "newMediaItemResults" not in resp:
+            for photo_file_name, _ in batch:
+                logging.error("Could not add \'{0}\' to library. Server Response -- {1}".format(photo_file_name.name, resp))
+            return [(photo_file_name, None, None, seconds) for photo_file_name, _ in batch]
+
+        # Results carry the upload token, fall back on the order of the request
+        by_token = {r.get('uploadToken'): r for r in resp["newMediaItemResults"]}
+        results = []
+        for n, (photo_file_name, upload_token) in enumerate(batch):
+            r = by_token.get(upload_token)
+            if r is None and n < len(resp["newMediaItemResults"]):
+                r = resp["newMediaItemResults"][n]
+            if r is None:
+                r = {'status': {'code': 2, 'message': 'No result returned for upload token'}}
+            results.append((photo_file_name, r.get('status', {}), r.get('mediaItem'), seconds))
+
+        return results
+
+# vim: ai et ts=4 sw=4 sts=4 nu
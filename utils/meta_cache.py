@@ -0,0 +1,108 @@
+import logging
+import os
+from datetime import datetime
+
+from utils.sqlite_store import SQLiteStore
+
+class MetaCache(SQLiteStore):
+    '''
+    SQLite cache of the metadata probe_meta reads from files on disk,
+    keyed by (device, inode, size, mtime), so an unchanged file costs only a stat.
+    Only used from the main process.
+    '''
+
+    def __init__(self, path):
+        super().__init__(path, ['''CREATE TABLE IF NOT EXISTS meta (
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                mime_type TEXT,
+                kind TEXT,
+                exif_datetime TEXT,
+                ffmpeg_creation TEXT,
+                fallback INTEGER,
+                PRIMARY KEY (dev, ino, size, mtime_ns))'''])
+        self.hits = 0
+        self.misses = 0
+        self.uncommitted = 0
+
+    @staticmethod
+    def key(stat):
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, media_on_disk, fallback=False):
+        '''
+        Fill in media_on_disk from the cache.  Returns False if not cached
+        '''
+
+        row = self.fetchone('''SELECT mime_type, kind, exif_datetime, ffmpeg_creation, fallback, path
+                FROM meta WHERE dev=? AND ino=? AND size=? AND mtime_ns=?''',
+                self.key(media_on_disk.stat))
+
+        # Renamed, the mimetype is guessed from the name
+        if row and row[5] != os.path.abspath(media_on_disk.path_obj):
+            row = None
+
+        # Probed without --probe-fallback, and found no timestamp
+        if row and fallback and not row[4] and not (row[2] or row[3]):
+            row = None
+
+        if not row:
+            self.misses += 1
+            return False
+
+        self.hits += 1
+        media_on_disk.mime_type, media_on_disk.kind, media_on_disk.exif_datetime = row[:3]
+        if row[3]:
+            media_on_disk.ffmpeg_creation = datetime.fromisoformat(row[3])
+        return True
+
+    def put(self, media_on_disk, fallback=False):
+        dev, ino, size, mtime_ns = self.key(media_on_disk.stat)
+        ffmpeg_creation = None
+        if media_on_disk.ffmpeg_creation:
+            ffmpeg_creation = media_on_disk.ffmpeg_creation.isoformat()
+
+        with self.lock:
+            # the same file, changed
+            self.conn.execute('DELETE FROM meta WHERE dev=? AND ino=?', (dev, ino))
+            self.conn.execute('INSERT INTO meta VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (dev, ino, size, mtime_ns, os.path.abspath(media_on_disk.path_obj),
+                     media_on_disk.mime_type, media_on_disk.kind,
+                     media_on_disk.exif_datetime, ffmpeg_creation, int(fallback)))
+            self.uncommitted += 1
+
+        if self.uncommitted >= 100:
+            self.commit()
+
+    def evict(self):
+        '''
+        Remove entries for files that are gone, or changed.  Returns the number removed
+        '''
+
+        stale = []
+        rows = self.fetchall('SELECT dev, ino, size, mtime_ns, path FROM meta')
+        for row in rows:
+            try:
+                if self.key(os.stat(row[4])) != row[:4]:
+                    stale.append(row[:4])
+            except OSError:
+                stale.append(row[:4])
+
+        self.executemany('DELETE FROM meta WHERE dev=? AND ino=? AND size=? AND mtime_ns=?', stale)
+        self.commit()
+        logging.debug('Metadata cache: evicted {} entries'.format(len(stale)))
+        return len(stale)
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        logging.debug('Metadata cache: {} hits, {} misses'.format(self.hits, self.misses))
+        super().close()
+
+# vim: ai et ts=4 sw=4 sts=4 nu
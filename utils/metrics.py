@@ -0,0 +1,222 @@
+'''
+Per-phase counters, byte totals and latency histograms for a run.
+
+The phases are discovery (finding files on disk), album_list (each page of albums,
+album contents and the library), probe (exif and ffmpeg), upload (byte transfer per file),
+batch_create (each mediaItems:batchCreate call) and batch_add (each albums:batchAddMediaItems
+call).  One registry per process, like logging:
+
+    from utils import metrics
+    with metrics.timer('upload', nbytes) as t:
+        ...
+        t.error = True
+
+The registry can be written as a JSON report, or in the Prometheus text format
+for the node exporter's textfile collector.
+'''
+
+from contextlib import contextmanager
+import json
+import math
+import os
+import threading
+import time
+
+PHASES = ('discovery', 'album_list', 'probe', 'upload', 'batch_create', 'batch_add')
+
+# seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, math.inf)
+
+PROMETHEUS_PREFIX = 'gphotos_upload'
+
+def le_text(le):
+    if le == math.inf:
+        return '+Inf'
+    return le if le is None else str(le)
+
+class Phase:
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds, nbytes=0, error=False):
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        if error:
+            self.errors += 1
+        for n, le in enumerate(BUCKETS):
+            if seconds <= le:
+                self.buckets[n] += 1
+                break
+
+    def quantile(self, q):
+        ''' upper bound of the bucket holding the q quantile, None if nothing observed '''
+
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for le, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return le
+        return math.inf
+
+    def report(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 3),
+            'p50_seconds_le': le_text(self.quantile(0.5)),
+            'p99_seconds_le': le_text(self.quantile(0.99)),
+            'buckets': {le_text(le): n for le, n in zip(BUCKETS, self.buckets)},
+        }
+
+class Timer:
+    ''' set error, or add to nbytes, before the timed block ends.  seconds is set once it has '''
+
+    def __init__(self, nbytes=0):
+        self.nbytes = nbytes
+        self.error = False
+        self.seconds = None
+
+class Metrics:
+    ''' Thread safe.  Other values, such as the file counts of the run, are kept as gauges '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.phases = {name: Phase(name) for name in PHASES}
+            self.gauges = {}
+
+    def observe(self, phase, seconds, nbytes=0, error=False):
+        with self.lock:
+            self.phases[phase].observe(seconds, nbytes, error)
+
+    @contextmanager
+    def timer(self, phase, nbytes=0):
+        t = Timer(nbytes)
+        started = time.monotonic()
+        try:
+            yield t
+        except Exception:
+            t.error = True
+            raise
+        finally:
+            t.seconds = time.monotonic() - started
+            self.observe(phase, t.seconds, t.nbytes, t.error)
+
+    def timed_iter(self, phase, iterable):
+        ''' yield from iterable, observing the time taken to produce each item '''
+
+        it = iter(iterable)
+        while True:
+            started = time.monotonic()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.observe(phase, time.monotonic() - started)
+            yield item
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    def report(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': round(time.time() - self.started, 3),
+                'phases': {name: phase.report() for name, phase in self.phases.items()},
+                'gauges': dict(self.gauges),
+            }
+
+    def summary(self):
+        ''' one line per phase, for the log '''
+
+        lines = []
+        with self.lock:
+            for phase in self.phases.values():
+                if not phase.count:
+                    continue
+                lines.append('{:<12} | {:>7} calls | {:>4} errors | {:>9.1f} MB | {:>8.1f}s | p50 <= {}s | p99 <= {}s'.format(
+                    phase.name, phase.count, phase.errors, phase.bytes / 1024 / 1024, phase.seconds,
+                    le_text(phase.quantile(0.5)), le_text(phase.quantile(0.99))))
+        return lines
+
+    def write_json(self, path):
+        write_atomic(path, json.dumps(self.report(), indent=2, default=str))
+
+    def write_prometheus(self, path):
+        write_atomic(path, self.prometheus())
+
+    def prometheus(self):
+        ''' Prometheus text exposition format, for the node exporter textfile collector '''
+
+        p = PROMETHEUS_PREFIX
+        report = self.report()
+        lines = [
+            '# HELP {}_phase_seconds Time spent per call of each phase'.format(p),
+            '# TYPE {}_phase_seconds histogram'.format(p),
+        ]
+        for name, phase in report['phases'].items():
+            cumulative = 0
+            for le, n in phase['buckets'].items():
+                cumulative += n
+                lines.append('{}_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(
+                    p, name, le, cumulative))
+            lines.append('{}_phase_seconds_sum{{phase="{}"}} {}'.format(p, name, phase['seconds']))
+            lines.append('{}_phase_seconds_count{{phase="{}"}} {}'.format(p, name, phase['count']))
+
+        for metric, key, help_text in (
+                ('phase_errors_total', 'errors', 'Failed calls per phase'),
+                ('phase_bytes_total', 'bytes', 'Bytes handled per phase')):
+            lines.append('# HELP {}_{} {}'.format(p, metric, help_text))
+            lines.append('# TYPE {}_{} counter'.format(p, metric))
+            for name, phase in report['phases'].items():
+                lines.append('{}_{}{{phase="{}"}} {}'.format(p, metric, name, phase[key]))
+
+        for name, value in sorted(report['gauges'].items()):
+            if isinstance(value, (int, float)):
+                lines.append('# TYPE {}_{} gauge'.format(p, name))
+                lines.append('{}_{} {}'.format(p, name, value))
+
+        lines.append('# TYPE {}_run_seconds gauge'.format(p))
+        lines.append('{}_run_seconds {}'.format(p, report['seconds']))
+        lines.append('# TYPE {}_last_run_timestamp_seconds gauge'.format(p))
+        lines.append('{}_last_run_timestamp_seconds {}'.format(p, int(time.time())))
+        return '\n'.join(lines) + '\n'
+
+def write_atomic(path, text):
+    ''' the textfile collector may read at any time, so never a partial file '''
+
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+REGISTRY = Metrics()
+
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed_iter = REGISTRY.timed_iter
+gauge = REGISTRY.gauge
+count = REGISTRY.count
+
+# vim: ai et ts=4 sw=4 sts=4 nu
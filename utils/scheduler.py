@@ -0,0 +1,207 @@
+'''
+Central request scheduler for the Google Photos Library API.
+
+Every request goes through a RequestScheduler, which keeps to a requests-per-second
+rate with a token bucket, stops the run after --max-requests requests, and retries
+429 and 5xx responses with jittered exponential backoff, honouring Retry-After.
+Connection errors are retried only for requests safe to send twice.
+
+All requests count towards the API's 10,000 requests a day per project, byte uploads
+and each chunk of a resumable upload included.  The count is per run: other runs,
+and other apps of the same project, are not counted.
+
+https://developers.google.com/photos/library/guides/api-limits-quotas
+'''
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Photos Library API default quota, requests per day and project
+API_QUOTA = 10000
+
+class QuotaExceeded(Exception):
+    pass
+
+def quota_day():
+    ''' the daily quota resets at midnight Pacific time '''
+    import arrow
+    return arrow.now('US/Pacific').date()
+
+class TokenBucket:
+    ''' rate tokens per second, bursts of up to capacity.  Thread safe '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        Take a token, possibly one not yet available.
+        Returns the seconds to wait before using it
+        '''
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+def retry_after_seconds(value):
+    ''' Retry-After is either seconds, or an HTTP date '''
+
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_upload(url):
+    ''' byte uploads, and the chunks of resumable uploads '''
+    return '/v1/uploads' in url
+
+def safe_to_resend(method, url):
+    '''
+    After a connection error the request may have been carried out, so only requests
+    that do no harm if carried out twice are sent again: reads, mediaItems:search,
+    and byte uploads, whose unused upload tokens expire.  A resent mediaItems:batchCreate
+    or album create would make duplicates
+    '''
+    return method.upper() in ('GET', 'HEAD') or is_upload(url) or url.endswith('mediaItems:search')
+
+class RequestScheduler:
+
+    def __init__(self, rate=None, max_requests=API_QUOTA, retries=5, backoff=1, max_backoff=64):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.max_requests = max_requests
+        # api counts all requests, uploads those of them that are byte uploads
+        self.used = {'api': 0, 'uploads': 0}
+        # a --watch run goes on for days, the count starts again each day
+        self.day = quota_day()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retried = 0
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        '''
+        Count a request, and take a token from the bucket.
+        Returns the seconds to wait before sending it.  Raises QuotaExceeded
+        '''
+
+        day = quota_day()
+        with self.lock:
+            if day != self.day:
+                logging.info('| Quota   | new day, {}'.format(self.report()))
+                self.day = day
+                self.used = {'api': 0, 'uploads': 0}
+            if self.max_requests and self.used['api'] >= self.max_requests:
+                raise QuotaExceeded('--max-requests of {} requests used'.format(self.max_requests))
+            self.used['api'] += 1
+            if is_upload(url):
+                self.used['uploads'] += 1
+
+        delay = self.bucket.reserve() if self.bucket else 0
+        if delay:
+            with self.lock:
+                self.throttled += delay
+        return delay
+
+    def retry_delay(self, attempt, status=None, retry_after=None):
+        '''
+        Seconds to wait before retrying, or None if the request should not be retried.
+        status is None for connection errors
+        '''
+
+        if attempt >= self.retries:
+            return None
+        if status is not None and status not in RETRY_STATUS:
+            return None
+
+        delay = retry_after_seconds(retry_after)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+        with self.lock:
+            self.retried += 1
+        return delay
+
+    def request(self, session, method, url, data=None, **kwargs):
+        '''
+        Send a request with session, a requests.Session, retrying transient failures,
+        and connection errors if safe_to_resend.
+        data may be a callable returning the body, so a streamed body can be sent again
+        '''
+
+        from requests.exceptions import ConnectionError, Timeout
+
+        attempt = 0
+        while True:
+            time.sleep(self.acquire(url))
+            try:
+                resp = session.request(method, url, data=data() if callable(data) else data, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                delay = self.retry_delay(attempt) if safe_to_resend(method, url) else None
+                if delay is None:
+                    raise
+                logging.info('| Retry   | {} {} in {:.1f}s: {}'.format(method, url, delay, e))
+            else:
+                delay = self.retry_delay(attempt, resp.status_code, resp.headers.get('Retry-After'))
+                if delay is None:
+                    return resp
+                logging.info('| Retry   | {} {} in {:.1f}s: {}'.format(method, url, delay, resp.status_code))
+
+            time.sleep(delay)
+            attempt += 1
+
+    def report(self):
+        return ('API requests: {} of {}, of them byte uploads: {}, '
+                'retries: {}, throttled: {:.1f}s'.format(
+                    self.used['api'], self.max_requests or 'unlimited', self.used['uploads'],
+                    self.retried, self.throttled))
+
+class ScheduledSession:
+    '''
+    A requests session whose requests go through a RequestScheduler.
+    Other attributes, such as headers and credentials, are the wrapped session's
+    '''
+
+    def __init__(self, session, scheduler):
+        self.session = session
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def request(self, method, url, **kwargs):
+        return self.scheduler.request(self.session, method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def clone(self, clone_session):
+        ''' the same scheduler, on a new session from clone_session(session) '''
+        return ScheduledSession(clone_session(self.session), self.scheduler)
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -3,9 +3,12 @@ import json
 import logging
 import textwrap
 
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import AuthorizedSession
-from google.oauth2.credentials import Credentials
+# Google APIs only compress responses for clients whose User-Agent contains gzip,
+# whatever the Accept-Encoding.  Listing a large album is mostly JSON, which compresses well
+USER_AGENT = 'gphotos-upload (gzip)'
+
+# The google auth stack is imported by the functions using it,
+# so parse_args, for --help and --dry-run, does not wait for it
 
 def parse_args(arg_input=None):
     parser = argparse.ArgumentParser(
@@ -40,8 +43,12 @@ def parse_args(arg_input=None):
                     help='Optional: used to store tokens and credentials, such as the refresh token')
     parser.add_argument('-c', '--credentials', required=True,
                     help='Path to client_id.json.')
-    parser.add_argument('--album', metavar='album_name', dest='album_name', required=True,
-                    help='Required.  Name of photo album to create (if it doesn\'t exist). Any uploaded photos will be added to this album.')
+    parser.add_argument('--album', metavar='album_name', dest='album_name',
+                    help='Required, unless --album-template.  Name of photo album to create (if it doesn\'t exist). Any uploaded photos will be added to this album.')
+    parser.add_argument('--album-template', metavar='template', dest='album_template',
+                    help='Upload each directory into its own album, named by the template, in one run. '
+                    '{dir}: name of the file\'s directory, {path}: its path below the directory given, '
+                    '{root}: name of the directory given, {album}: --album. Example: "{album} {path}"')
     parser.add_argument('--log', metavar='log_file', dest='log_file',
                     help='Name of output file for log messages')
     parser.add_argument('--tz', metavar='time_zone', dest='tz', default='Europe/London',
@@ -64,12 +71,144 @@ def parse_args(arg_input=None):
             help='Number of minutes in timestamp (st_atime) difference to accept as a match. '
             'That is, if filename, album, mimetype match, but exif.datetime does not exist, or is not a match '
             'then compare st_atime. Default: 0')
+    parser.add_argument('-w', '--workers', metavar='workers', type=int, dest='workers',
+            default=1,
+            help='Number of files to upload in parallel.  Each worker uses its own session. Default: 1')
+    parser.add_argument('--backend', dest='backend', default='sync',
+            choices=['sync', 'async'],
+            help='sync: upload with --workers threads. async: upload with asyncio and aiohttp, '
+            'up to --concurrency requests at a time. Default: sync')
+    parser.add_argument('--concurrency', metavar='concurrency', type=int, dest='concurrency',
+            default=8,
+            help='With --backend async, the number of concurrent requests. Default: 8')
+    parser.add_argument('--probe-workers', metavar='probe_workers', type=int, dest='probe_workers',
+            default=0,
+            help='Number of processes reading exif and ffmpeg metadata ahead of the uploads. 0 reads them inline. Default: 0')
+    parser.add_argument('--probe-fallback', action='store_true',
+            help='Images are only read for exif, and videos only probed by ffmpeg. '
+            'With this, also try the other when the first finds no timestamp')
+    parser.add_argument('--meta-cache', metavar='meta_cache_file', dest='meta_cache',
+            help='Optional: SQLite file caching exif, ffmpeg creation time and mimetype, by device, inode, size and mtime. '
+            'Unchanged files are not probed again')
+    parser.add_argument('--evict-meta-cache', action='store_true',
+            help='At the end of the run, remove --meta-cache entries for files that are gone or changed')
+    parser.add_argument('--batch-size', metavar='batch_size', type=int, dest='batch_size',
+            default=50,
+            help='Number of uploaded files to add to the album per mediaItems:batchCreate call, at most 50. Default: 50')
+    parser.add_argument('--batch-wait', metavar='seconds', type=float, dest='batch_wait',
+            default=30,
+            help='Add uploaded files to the album after this many seconds, even if the batch is not full. Default: 30')
+    parser.add_argument('--resumable', metavar='MB', type=int, dest='resumable_mb',
+            default=100,
+            help='Files larger than this many MB are uploaded in chunks, resuming after errors. 0 disables. Default: 100')
+    parser.add_argument('--chunk', metavar='MB', type=int, dest='chunk_mb',
+            default=16,
+            help='Chunk size in MB for resumable uploads. Default: 16')
+    parser.add_argument('--rate', metavar='requests_per_second', type=float, dest='rate',
+            default=0,
+            help='Maximum requests per second to the Photos API, 0 for no limit. Default: 0')
+    parser.add_argument('--max-requests', metavar='requests', type=int, dest='max_requests',
+            default=10000,
+            help='Stop after this many requests to the Photos API in this run, or in each day of a --watch run, '
+            'byte uploads and resumable chunks included, 0 for no limit. Other runs are not counted, '
+            'though they share the API quota of 10000 requests a day. Default: 10000')
+    parser.add_argument('--retries', metavar='retries', type=int, dest='retries',
+            default=5,
+            help='Retry 429 and 5xx responses this many times, with backoff, and connection errors '
+            'of requests safe to send twice: reads, searches and byte uploads. Default: 5')
+    parser.add_argument('--dedupe', action='store_true',
+            help='Upload only one of several files with the same content, e.g. copies of a card in different folders. '
+            'Files are compared by size, then a partial hash, then a full hash')
+    parser.add_argument('--ledger', metavar='ledger_file', dest='ledger',
+            help='Optional: SQLite file recording uploaded files. Files unchanged since they were uploaded '
+            'to the album are passed without comparing')
+    parser.add_argument('--journal', metavar='journal_file', dest='journal',
+            help='Optional: SQLite file journaling the run as it goes, each upload token and mediaItems:batchCreate result. '
+            'Cleared at the start of a run, unless --resume')
+    parser.add_argument('--resume', action='store_true',
+            help='With --journal, resume an interrupted run: files uploaded but not added are added without uploading '
+            'them again (upload tokens are valid for a day), and files already added are passed')
+    parser.add_argument('--library-index', metavar='index_file', dest='library_index',
+            help='Optional: SQLite index of the media items already in the library, in any album or none, '
+            'by filename and creation time. A file found there is added to the album without uploading it again. '
+            'Listed in full the first time and every --library-ttl hours, in between only the photos taken most recently. '
+            'Not with --skip-compare, as files are not probed for their creation time')
+    parser.add_argument('--library-ttl', metavar='hours', type=float, dest='library_ttl',
+            default=168,
+            help='List the whole library again once the last full listing is older than this many hours. Default: 168')
+    parser.add_argument('--refresh-library', action='store_true',
+            help='With --library-index, list the whole library again now. On a large library that is many requests')
+    parser.add_argument('--no-atime', dest='set_atime', action='store_false',
+            help='Do not update st_atime of uploaded files. Useful with --ledger, or on a NAS')
+    parser.add_argument('--cache-dir', metavar='cache_dir', dest='cache_dir',
+            help='Optional: directory for snapshots of album contents, reused across runs. '
+            'Items uploaded by this tool are added to the snapshot. Changes made elsewhere are only seen after a refresh')
+    parser.add_argument('--cache-ttl', metavar='hours', type=float, dest='cache_ttl',
+            default=24,
+            help='Refresh album snapshots older than this many hours. Default: 24')
+    parser.add_argument('--refresh-cache', action='store_true',
+            help='Fetch album contents from Google, and save a new snapshot')
+    parser.add_argument('--offline', action='store_true',
+            help='With --test-stat-times and --cache-dir, compare with the album snapshot, whatever its age, without connecting to Google')
+    parser.add_argument('--manifest', metavar='manifest_file', dest='manifest',
+            help='Optional: write the outcome of each file as JSON lines, as the run goes: '
+            'path, size, decision, reason, upload and create seconds, bytes sent, mediaItem id, error')
+    parser.add_argument('--metrics-json', metavar='json_file', dest='metrics_json',
+            help='Optional: write counts, bytes and latency histograms per phase '
+            '(discovery, album_list, probe, upload, batch_create, batch_add) to this JSON file')
+    parser.add_argument('--metrics-prom', metavar='prom_file', dest='metrics_prom',
+            help='Optional: write the same metrics in the Prometheus text format, '
+            'e.g. into the node exporter textfile collector directory as gphotos_upload.prom')
+    parser.add_argument('--watch', action='store_true',
+            help='After uploading, keep running and upload files as they are added to or changed in the directories, '
+            'using inotify on Linux, else polling. Stop with Ctrl-C')
+    parser.add_argument('--watch-settle', metavar='seconds', type=float, dest='watch_settle',
+            default=5,
+            help='With --watch, upload a file once it is closed and unchanged for this many seconds. Default: 5')
+    parser.add_argument('--watch-poll', metavar='seconds', type=float, dest='watch_poll',
+            default=0,
+            help='With --watch, walk the directories every this many seconds instead of using inotify, '
+            'e.g. for network shares. Default: 0, inotify when available, else every 10 seconds')
     parser.add_argument('photos', metavar='photo',type=str, nargs='*',
             help='List of filenames or directories of photos and videos to upload. '
                 "Quote Windows path, to be safe: 'z:/path/to/file'.  "
                 "Note: Windows does not handle wildcards such as 'z:/path/to/*', use files or dirs for Windows")
 
-    return parser.parse_args(arg_input)
+    args = parser.parse_args(arg_input)
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    if args.probe_workers < 0:
+        parser.error('--probe-workers can not be negative')
+    if not 1 <= args.batch_size <= 50:
+        parser.error('--batch-size must be between 1 and 50')
+    if args.chunk_mb < 1:
+        parser.error('--chunk must be at least 1')
+    if not (args.album_name or args.album_template):
+        parser.error('--album or --album-template is required')
+    if args.album_template:
+        try:
+            args.album_template.format(album='', root='', dir='', path='')
+        except (KeyError, IndexError, ValueError) as e:
+            parser.error('--album-template {}: use {{dir}}, {{path}}, {{root}} or {{album}}'.format(e))
+    if args.offline and not (args.stat_times and args.cache_dir):
+        parser.error('--offline requires --test-stat-times and --cache-dir')
+    if args.resume and not args.journal:
+        parser.error('--resume requires --journal')
+    if args.watch and (args.dry_run or args.stat_times):
+        parser.error('--watch can not be used with --dry-run or --test-stat-times')
+    if args.refresh_library and not args.library_index:
+        parser.error('--refresh-library requires --library-index')
+    if args.library_index and args.skip_compare:
+        # the library would be listed, and never looked up
+        parser.error('--library-index can not be used with --skip-compare')
+    if args.library_ttl < 0:
+        parser.error('--library-ttl can not be negative')
+    if args.watch_settle < 0 or args.watch_poll < 0:
+        parser.error('--watch-settle and --watch-poll can not be negative')
+
+    return args
 
 def save_cred(cred, auth_file):
 
@@ -88,6 +227,8 @@ def save_cred(cred, auth_file):
 
 
 def auth(scopes, credentials):
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     flow = InstalledAppFlow.from_client_secrets_file(
         credentials,
         scopes=scopes)
@@ -110,6 +251,8 @@ def get_authorized_session(auth_token_file, credentials,
 
     logging.debug('scopes: {}'.format(scopes))
 
+    from google.oauth2.credentials import Credentials
+
     logging.debug('entering def get_auth')
     cred = None
 
@@ -129,7 +272,7 @@ def get_authorized_session(auth_token_file, credentials,
         logging.debug("cred: {}".format(cred))
 
     logging.debug('line 56')
-    session = AuthorizedSession(cred)
+    session = new_session(cred)
 
     if auth_token_file:
         try:
@@ -139,3 +282,24 @@ def get_authorized_session(auth_token_file, credentials,
 
     return session
 
+def clone_session(session):
+    '''
+    A new AuthorizedSession sharing the credentials of session.
+    Used to give each upload worker thread its own connection pool
+    '''
+
+    # a utils.scheduler.ScheduledSession keeps its scheduler
+    if hasattr(session, 'clone'):
+        return session.clone(clone_session)
+
+    return new_session(session.credentials)
+
+def new_session(credentials):
+    ''' AuthorizedSession for credentials, asking for compressed responses '''
+
+    from google.auth.transport.requests import AuthorizedSession
+
+    session = AuthorizedSession(credentials)
+    session.headers['User-Agent'] = USER_AGENT
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
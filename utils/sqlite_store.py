@@ -0,0 +1,46 @@
+import sqlite3
+import threading
+
+class SQLiteStore:
+    '''
+    An SQLite file shared by the threads of a run: the ledger, journal, metadata cache
+    and library index.  Statements run one at a time under a lock, and are committed
+    with commit, or close.  Subclasses take the lock themselves for several statements
+    that go together
+    '''
+
+    def __init__(self, path, schema=(), pragmas=()):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        for pragma in pragmas:
+            self.conn.execute('PRAGMA ' + pragma)
+        for statement in schema:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        with self.lock:
+            return self.conn.executemany(sql, rows)
+
+    def fetchone(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+# vim: ai et ts=4 sw=4 sts=4 nu
@@ -0,0 +1,76 @@
+import hashlib
+import logging
+import os
+from datetime import datetime
+
+from utils.sqlite_store import SQLiteStore
+
+FINGERPRINT_BLOCK = 64 * 1024
+
+def fingerprint(path, size=None):
+    '''
+    Cheap content fingerprint: sha1 of the size, first and last 64KB
+    '''
+
+    if size is None:
+        size = os.path.getsize(path)
+
+    h = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(FINGERPRINT_BLOCK))
+        if size > FINGERPRINT_BLOCK:
+            f.seek(max(FINGERPRINT_BLOCK, size - FINGERPRINT_BLOCK))
+            h.update(f.read(FINGERPRINT_BLOCK))
+
+    return h.hexdigest()
+
+class UploadLedger(SQLiteStore):
+    '''
+    SQLite record of files uploaded, per album.
+    A file whose size and mtime have not changed since it was recorded
+    does not need comparing or uploading again.
+    '''
+
+    def __init__(self, path):
+        super().__init__(path, ['''CREATE TABLE IF NOT EXISTS uploads (
+                path TEXT NOT NULL,
+                album TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                fingerprint TEXT,
+                media_item_id TEXT,
+                uploaded TEXT,
+                PRIMARY KEY (path, album))'''])
+
+    @staticmethod
+    def key(photo_file_name, album_name):
+        return os.path.abspath(photo_file_name), album_name.lower()
+
+    def uploaded(self, photo_file_name, album_name, stat=None):
+        row = self.fetchone('SELECT size, mtime_ns FROM uploads WHERE path=? AND album=?',
+                self.key(photo_file_name, album_name))
+        if not row:
+            return False
+
+        try:
+            if stat is None:
+                stat = os.stat(photo_file_name)
+        except OSError:
+            return False
+
+        return row == (stat.st_size, stat.st_mtime_ns)
+
+    def record(self, photo_file_name, album_name, media_item_id):
+        try:
+            stat = os.stat(photo_file_name)
+            fp = fingerprint(photo_file_name, stat.st_size)
+        except OSError as e:
+            logging.info('| Ledger: could not record {}: {}'.format(photo_file_name, e))
+            return
+
+        path, album = self.key(photo_file_name, album_name)
+        self.execute('INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, album, stat.st_size, stat.st_mtime_ns, fp, media_item_id,
+                 datetime.now().isoformat()))
+
+# vim: ai et ts=4 sw=4 sts=4 nu
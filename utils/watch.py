@@ -0,0 +1,310 @@
+'''
+Watch directories for new and changed files, for upload.py --watch.
+
+On Linux, inotify tells when a file is closed after writing, or moved in.
+Elsewhere, or when inotify can not be used, the directories are walked every
+few seconds instead, looking for files whose size or mtime changed.
+Either way a file is only reported once it has been unchanged for settle seconds,
+so files still being copied, or written by a camera app in several passes, are not
+uploaded half written.
+
+https://man7.org/linux/man-pages/man7/inotify.7.html
+'''
+
+from collections import deque
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import select
+import struct
+import time
+
+POLL_SECONDS = 10
+HEARTBEAT_SECONDS = 1
+
+# linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+EVENT = struct.Struct('iIII')
+
+def file_state(path):
+    ''' (size, mtime_ns), None if path is not a file '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def list_dirs(root, recurse):
+    ''' root and, with recurse 'all', the directories below it, each directory once '''
+
+    if recurse == 'none':
+        return
+
+    dirs = deque([root])
+    visited = set()
+    while dirs:
+        d = dirs.popleft()
+        try:
+            st = os.stat(d)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            yield d
+
+            if recurse == 'all':
+                with os.scandir(d) as it:
+                    dirs.extend(entry.path for entry in it if entry.is_dir())
+        except OSError as e:
+            logging.error('{}'.format(e))
+
+def list_files(d):
+    try:
+        with os.scandir(d) as it:
+            return [entry.path for entry in it if entry.is_file()]
+    except OSError as e:
+        logging.error('{}'.format(e))
+        return []
+
+class Settler:
+    '''
+    Files seen changing, each reported once its size and mtime have not changed
+    for settle seconds
+    '''
+
+    def __init__(self, settle):
+        self.settle = settle
+        self.candidates = {}
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def touch(self, path):
+        state = file_state(path)
+        if state is not None:
+            self.candidates[path] = (state, time.monotonic())
+
+    def settled(self):
+        ''' the files unchanged for long enough, which are then forgotten '''
+
+        now = time.monotonic()
+        ready = []
+        for path, (state, since) in list(self.candidates.items()):
+            current = file_state(path)
+            if current is None:
+                # deleted, or moved away, before it settled
+                del self.candidates[path]
+            elif current != state:
+                self.candidates[path] = (current, now)
+            elif now - since >= self.settle:
+                del self.candidates[path]
+                ready.append(path)
+        return ready
+
+    def time_left(self):
+        ''' seconds until the next candidate could settle, None if there are none '''
+        if not self.candidates:
+            return None
+        now = time.monotonic()
+        return max(0, min(since + self.settle - now for state, since in self.candidates.values()))
+
+class Inotify:
+    ''' inotify through libc, watching directories.  Raises OSError if it can not be used '''
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'libc not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.dirs = {}
+
+    def add(self, d):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, '{}: {}'.format(os.strerror(e), d))
+        self.dirs[wd] = d
+
+    def read(self, timeout):
+        '''
+        Wait up to timeout seconds for events.
+        Returns a list of (path, mask), path is None for IN_Q_OVERFLOW
+        '''
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+            name = buf[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            d = self.dirs.get(wd)
+            if d is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed, or unmounted
+                del self.dirs[wd]
+                continue
+            events.append((os.path.join(d, os.fsdecode(name)) if name else d, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher:
+    '''
+    Watches directories for files that are new or changed and then settle.
+    It starts watching when created, so nothing written while the caller
+    uploads the files already there is missed.
+    recurse is as upload.py --recurse.  With poll, or when inotify can not be used,
+    the directories are walked every poll (by default POLL_SECONDS) seconds instead
+    '''
+
+    def __init__(self, dirs, recurse, settle, poll=0):
+        self.roots = [os.fspath(d) for d in dirs]
+        self.recurse = recurse
+        self.settler = Settler(settle)
+        self.poll = poll
+        self.inotify = None
+        self.snapshot = {}
+
+        if not poll:
+            try:
+                self.inotify = Inotify()
+                for root in self.roots:
+                    for d in list_dirs(root, recurse):
+                        self.inotify.add(d)
+            except OSError as e:
+                logging.info('| Watch   | inotify not available, polling every {}s: {}'.format(POLL_SECONDS, e))
+                if self.inotify:
+                    self.inotify.close()
+                self.inotify = None
+                self.poll = POLL_SECONDS
+
+        if self.inotify is None:
+            self.snapshot = self.scan()
+
+    @property
+    def method(self):
+        return 'inotify' if self.inotify else 'polling every {}s'.format(self.poll)
+
+    def scan(self):
+        ''' {path: (size, mtime_ns)} of the files in the watched directories '''
+
+        found = {}
+        for root in self.roots:
+            for d in list_dirs(root, self.recurse):
+                for path in list_files(d):
+                    state = file_state(path)
+                    if state is not None:
+                        found[path] = state
+        return found
+
+    def new_dir(self, d):
+        ''' watch a directory created, or moved in, below a watched one, and its files '''
+
+        for sub in list_dirs(d, 'all'):
+            try:
+                self.inotify.add(sub)
+            except OSError as e:
+                logging.error('Could not watch {}'.format(e))
+            # files written before the watch was added
+            for path in list_files(sub):
+                self.settler.touch(path)
+
+    def handle(self, path, mask):
+        if path is None:
+            logging.info('| Watch   | inotify queue overflowed, checking all files')
+            for path in self.scan():
+                self.settler.touch(path)
+        elif mask & IN_ISDIR:
+            if self.recurse == 'all' and mask & (IN_CREATE | IN_MOVED_TO):
+                self.new_dir(path)
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            pass
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self.settler.touch(path)
+        elif mask & IN_MODIFY and path in self.settler.candidates:
+            # written again after it was closed, wait for it to settle again
+            self.settler.touch(path)
+
+    def changes(self):
+        ''' by polling: the files new, or changed, since the last scan '''
+
+        found = self.scan()
+        changed = [path for path, state in found.items() if self.snapshot.get(path) != state]
+        self.snapshot = found
+        return changed
+
+    def files(self, heartbeat=HEARTBEAT_SECONDS):
+        '''
+        Generator of the paths of files as they settle, forever.
+        Yields None when nothing has settled for heartbeat seconds,
+        so the caller can get on with other work in between
+        '''
+
+        next_poll = time.monotonic() + self.poll
+        try:
+            while True:
+                timeout = heartbeat
+                time_left = self.settler.time_left()
+                if time_left is not None:
+                    timeout = min(timeout, time_left)
+
+                if self.inotify:
+                    for path, mask in self.inotify.read(timeout):
+                        self.handle(path, mask)
+                else:
+                    time.sleep(max(0, min(timeout, next_poll - time.monotonic())))
+                    if time.monotonic() >= next_poll:
+                        for path in self.changes():
+                            self.settler.touch(path)
+                        next_poll = time.monotonic() + self.poll
+
+                settled = self.settler.settled()
+                for path in sorted(settled):
+                    yield Path(path)
+                if not settled:
+                    yield None
+        finally:
+            if self.inotify:
+                self.inotify.close()
+
+# vim: ai et ts=4 sw=4 sts=4 nu